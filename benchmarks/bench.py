@@ -0,0 +1,409 @@
+"""
+Benchmarks for phoray.
+
+Times the building blocks of a trace (vector math, surface
+intersections, element propagation, ray generation) and batch traces
+of a few reference systems, and compares the rates with a stored
+baseline. The reference systems are traced in a fresh process each,
+so that their peak memory use can be measured.
+
+    python benchmarks/bench.py              # compare with baseline.json
+    python benchmarks/bench.py --quick      # fewer rays, for a quick check
+    python benchmarks/bench.py --save benchmarks/baseline.json
+
+The exit status is 1 if anything got slower (or bigger) than the
+baseline by more than the tolerance. Rates depend a lot on the
+machine, so the baselines are not kept in the repository: save one
+before making changes, on the machine it is compared on. A baseline
+saved on another host, or with another Python or numpy, is not
+compared with.
+"""
+
+from __future__ import division
+from argparse import ArgumentParser
+from math import asin, atan2, degrees
+from multiprocessing import Pool
+from time import time
+import json
+import os
+import platform
+import resource
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from phoray.element import (Mirror, Detector, Screen, ReflectiveGrating,
+                            Glass)
+from phoray.minivec import Vec, Mat
+from phoray.ray import Ray, RayBundle
+from phoray.source import GaussianSource
+from phoray.surface import Plane, Sphere, Cylinder, Ellipsoid, Paraboloid
+from phoray.system import Free
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# --quick runs use fewer rays, so they are compared with their own
+BASELINE_QUICK = os.path.join(os.path.dirname(__file__),
+                              "baseline_quick.json")
+
+# ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def timed(func, repeat=3, min_time=0.2):
+    """The best time of running func, at least repeat times and until
+    min_time seconds have passed (at most 100 times)."""
+    times = []
+    while len(times) < repeat or (sum(times) < min_time and
+                                  len(times) < 100):
+        start = time()
+        func()
+        times.append(time() - start)
+    return min(times)
+
+
+def max_rss():
+    """The peak memory use of this process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+# Micro benchmarks
+
+def vector_benchmarks(n):
+    """Operations on Vec and Mat; n operations per run."""
+    v, w = Vec(1.0, 2.0, 3.0), Vec(-0.5, 0.25, 2.0)
+    m = Mat().rotate(10, 20, 30)
+    angles = [Vec(i % 360, 0.5 * i, 0) for i in xrange(n)]
+    cases = [("vec add", lambda: [v + w for i in xrange(n)]),
+             ("vec dot", lambda: [v.dot(w) for i in xrange(n)]),
+             ("vec cross", lambda: [v.cross(w) for i in xrange(n)]),
+             ("vec normalize", lambda: [v.normalize() for i in xrange(n)]),
+             ("vec transform", lambda: [v.transform(m) for i in xrange(n)]),
+             ("mat multiply", lambda: [m * m for i in xrange(n)]),
+             ("mat rotate", lambda: [Mat().rotate(a) for a in angles])]
+    for name, func in cases:
+        yield name, "ops", n, func
+
+
+def local_rays(n, seed=0):
+    """Rays coming from below, towards the middle of a surface of
+    size 1 x 1 centered on the origin, in its local coordinates."""
+    random = np.random.RandomState(seed)
+    origins = np.column_stack((random.uniform(-0.4, 0.4, (n, 2)),
+                               np.full(n, -0.5)))
+    directions = np.column_stack((random.normal(0, 0.05, (n, 2)),
+                                  np.ones(n)))
+    directions /= np.sqrt((directions ** 2).sum(axis=1))[:, np.newaxis]
+    return RayBundle(origins, directions, 1e-7)
+
+
+def surfaces():
+    return [("plane", Plane(xsize=1.0, ysize=1.0)),
+            ("sphere", Sphere(R=2.0, xsize=1.0, ysize=1.0)),
+            ("cylinder", Cylinder(R=2.0, xsize=1.0, ysize=1.0)),
+            ("ellipsoid", Ellipsoid(a=2.0, b=3.0, c=2.0,
+                                    xsize=1.0, ysize=1.0)),
+            ("paraboloid", Paraboloid(a=1.0, b=1.0, c=-1.0,
+                                      xsize=1.0, ysize=1.0))]
+
+
+def surface_benchmarks(n, n_scalar):
+    """Intersecting each kind of surface, one ray at a time and as a
+    bundle."""
+    bundle = local_rays(n)
+    rays = local_rays(n_scalar).to_rays()
+    for name, surface in surfaces():
+        yield ("%s intersect" % name, "rays", n_scalar,
+               lambda s=surface: [s.intersect(ray) for ray in rays])
+        yield ("%s intersect_many" % name, "rays", n,
+               lambda s=surface: s.intersect_many(bundle.endpoints,
+                                                  bundle.directions))
+
+
+def elements():
+    return [("mirror", Mirror(geometry=Sphere(R=2.0, xsize=1.0, ysize=1.0))),
+            ("detector", Detector(geometry=Plane(xsize=1.0, ysize=1.0))),
+            ("screen", Screen(geometry=Plane(xsize=1.0, ysize=1.0))),
+            ("grating", ReflectiveGrating(
+                d=1e-6, order=1,
+                geometry=Sphere(R=2.0, xsize=1.0, ysize=1.0))),
+            ("glass", Glass(index1=1.0, index2=1.5,
+                            geometry=Plane(xsize=1.0, ysize=1.0)))]
+
+
+def element_benchmarks(n, n_scalar):
+    """Propagating rays through each kind of element, one at a time
+    and as a bundle."""
+    bundle = local_rays(n)
+    rays = local_rays(n_scalar).to_rays()
+    for name, element in elements():
+        yield ("%s propagate" % name, "rays", n_scalar,
+               lambda e=element: [e.propagate(ray) for ray in rays])
+        yield ("%s propagate_many" % name, "rays", n,
+               lambda e=element: e.propagate_many(bundle, record=False))
+
+
+def source_benchmarks(n, n_scalar):
+    """Generating rays from a Gaussian source."""
+    source = GaussianSource(size=Vec(1e-3, 1e-3, 0),
+                            divergence=Vec(0.05, 0.05, 0),
+                            random_seed=1, wavelength=1e-7,
+                            rotation=Vec(10, 20, 0))
+    yield ("gaussian generate", "rays", n_scalar,
+           lambda: list(source.generate(n_scalar)))
+    yield ("gaussian generate_many", "rays", n,
+           lambda: source.generate_many(n))
+
+
+# Reference systems
+
+def facing(direction):
+    """The rotation that turns the local z axis along direction."""
+    x, y, z = direction
+    return Vec(degrees(atan2(-y, z)), degrees(asin(x)), 0)
+
+
+def build(source, parts):
+    """A system where each element is placed on the axis ray from the
+    source. parts is a list of (element class, keyword arguments,
+    distance from the previous element, tilt); the element is turned
+    to face the axis ray and then tilted by the given angles."""
+    ray = Ray(source.position, source.globalize_direction(source.axis),
+              source.wavelength)
+    system = Free(sources=[source])
+    for cls, kwargs, distance, tilt in parts:
+        element = cls(position=ray.endpoint + ray.direction * distance,
+                      rotation=facing(ray.direction) + tilt, **kwargs)
+        ray = element.propagate(ray)
+        if ray is None:
+            raise ValueError("The axis misses %s" % cls.__name__)
+        system.elements.append(element)
+    system.clear_records()
+    return system
+
+
+def gaussian(size=0.0, divergence=0.05):
+    return GaussianSource(size=Vec(size, size, 0),
+                          divergence=Vec(divergence, divergence, 0),
+                          random_seed=1, wavelength=1e-8)
+
+
+def plane_mirror():
+    """A flat mirror turning the beam by 90 degrees."""
+    return build(gaussian(1e-3), [
+        (Mirror, dict(geometry=Plane(xsize=0.1, ysize=0.1)),
+         1.0, Vec(45, 0, 0)),
+        (Detector, dict(geometry=Plane(xsize=0.1, ysize=0.1)),
+         1.0, Vec(0, 0, 0))])
+
+
+def rowland_grating():
+    """A spherical grating at grazing incidence, with the source on
+    the Rowland circle, as in a spectrometer."""
+    R, angle = 1.0, 80
+    return build(gaussian(1e-5), [
+        (ReflectiveGrating, dict(d=1 / 1200e3, order=1,
+                                 geometry=Sphere(R=R, xsize=0.03,
+                                                 ysize=0.1)),
+         R * np.cos(np.radians(angle)), Vec(angle, 0, 0)),
+        (Detector, dict(geometry=Plane(xsize=0.1, ysize=0.1)),
+         0.2, Vec(0, 0, 0))])
+
+
+def kb_pair():
+    """A Kirkpatrick-Baez pair of elliptical mirrors at grazing
+    incidence, focusing in the vertical and then the horizontal."""
+    return build(gaussian(1e-5), [
+        (Mirror, dict(geometry=Ellipsoid(a=0.05, b=1.0, c=0.05,
+                                         xsize=0.02, ysize=0.3)),
+         1.0, Vec(87, 0, 0)),
+        (Mirror, dict(geometry=Ellipsoid(a=1.0, b=0.05, c=0.05,
+                                         xsize=0.3, ysize=0.02)),
+         0.2, Vec(0, 87, 0)),
+        (Detector, dict(geometry=Plane(xsize=0.1, ysize=0.1)),
+         0.8, Vec(0, 0, 0))])
+
+
+def paraboloid_collimator():
+    """A point source in the focus of a paraboloid mirror, which
+    sends the rays back as a parallel beam."""
+    return build(gaussian(0.0, 5.0), [
+        (Mirror, dict(geometry=Paraboloid(a=1.0, b=1.0, c=-0.25,
+                                          xsize=0.5, ysize=0.5)),
+         1.0, Vec(0, 0, 0)),
+        (Screen, dict(geometry=Plane(xsize=0.5, ysize=0.5)),
+         0.5, Vec(0, 0, 0)),
+        (Detector, dict(geometry=Plane(xsize=0.5, ysize=0.5)),
+         0.5, Vec(0, 0, 0))])
+
+
+SYSTEMS = [("plane mirror", plane_mirror),
+           ("rowland grating", rowland_grating),
+           ("kb pair", kb_pair),
+           ("paraboloid collimator", paraboloid_collimator)]
+
+
+def _trace_system(task):
+    """Trace a reference system, in a process of its own. Returns the
+    time, the memory used on top of what the process started with,
+    and the fraction of the rays that reached the end."""
+    name, n, repeat = task
+    system = dict(SYSTEMS)[name]()
+    rss = max_rss()
+    result = []
+
+    def trace():
+        result[:] = [system.trace_bundle(n)]
+
+    seconds = timed(trace, repeat)
+    memory = max(max_rss() - rss, 0)
+    survived = np.count_nonzero(result[0].rays[-1].alive) / n
+    return seconds, memory, survived
+
+
+def system_benchmarks(sizes, repeat, pattern=None):
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        for name, _ in SYSTEMS:
+            for n in sizes:
+                benchmark = "%s trace %.0e" % (name, n)
+                if pattern and pattern not in benchmark:
+                    continue
+                seconds, memory, survived = pool.apply(_trace_system,
+                                                       ((name, n, repeat),))
+                yield dict(name=benchmark, unit="rays",
+                           count=n, seconds=seconds, rate=n / seconds,
+                           memory=memory, survived=survived)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(quick=False, pattern=None):
+    """Run the benchmarks, printing the results as they come. Returns
+    a dict of results by name."""
+    if quick:
+        n, n_scalar, sizes, repeat = 10000, 300, [1000, 10000], 1
+    else:
+        n, n_scalar, sizes, repeat = 100000, 1000, [1000, 10000, 100000,
+                                                    1000000], 3
+    micro = [vector_benchmarks(n_scalar * 10),
+             surface_benchmarks(n, n_scalar),
+             element_benchmarks(n, n_scalar),
+             source_benchmarks(n, n_scalar)]
+    results = {}
+
+    def report(result):
+        results[result["name"]] = result
+        print "%-40s %12.4g %s/s" % (result["name"], result["rate"],
+                                    result["unit"]),
+        if "memory" in result:
+            print " %8.1f MB  %5.1f%% survived" % (
+                result["memory"] / 1024 ** 2, 100 * result["survived"]),
+        print
+        sys.stdout.flush()
+
+    for benchmarks in micro:
+        for name, unit, count, func in benchmarks:
+            if pattern and pattern not in name:
+                continue
+            seconds = timed(func, repeat)
+            report(dict(name=name, unit=unit, count=count,
+                        seconds=seconds, rate=count / seconds))
+    for result in system_benchmarks(sizes, repeat, pattern):
+        report(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print how the results compare with the baseline. Returns the
+    names of the benchmarks that got worse by more than tolerance (a
+    fraction). Benchmarks run on a different number of items than in
+    the baseline are not compared."""
+    worse = []
+    print
+    print "%-40s %10s %10s" % ("compared with baseline", "rate", "memory")
+    for name in sorted(results):
+        if (name not in baseline or
+                baseline[name]["count"] != results[name]["count"]):
+            continue
+        result, base = results[name], baseline[name]
+        speed = result["rate"] / base["rate"]
+        line = "%-40s %9.2fx" % (name, speed)
+        flagged = speed < 1 - tolerance
+        if base.get("memory"):
+            growth = result["memory"] / base["memory"]
+            line += " %9.2fx" % growth
+            # small allocations are too noisy to compare
+            flagged |= (growth > 1 + tolerance and
+                        result["memory"] - base["memory"] > 1024 ** 2)
+        if flagged:
+            worse.append(name)
+            line += "  <--"
+        print line
+    return worse
+
+
+def environment(quick):
+    """What the results depend on, besides the code; saved with them,
+    and compared before comparing the results."""
+    return dict(node=platform.node(), machine=platform.machine(),
+                python=platform.python_version(), numpy=np.__version__,
+                quick=quick)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmarks for phoray.")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer rays and repeats")
+    parser.add_argument("--filter", metavar="TEXT",
+                        help="only run benchmarks with TEXT in the name")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="results to compare with (default %s, or %s "
+                        "with --quick)" % (os.path.basename(BASELINE),
+                                           os.path.basename(BASELINE_QUICK)))
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results, e.g. as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown, as a fraction "
+                        "(default %(default)s)")
+    args = parser.parse_args(argv)
+
+    baseline = args.baseline or (BASELINE_QUICK if args.quick else BASELINE)
+    results = run(args.quick, args.filter)
+
+    env = environment(args.quick)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(dict(env, results=results),
+                      f, indent=1, sort_keys=True, separators=(",", ": "))
+    if baseline == args.save:
+        return 0
+    if not os.path.exists(baseline):
+        print
+        print "No baseline to compare with; save one with --save %s" % (
+            baseline)
+        return 0
+    with open(baseline) as f:
+        saved = json.load(f)
+    different = sorted(key for key, value in env.items()
+                       if saved.get(key) != value)
+    if different:
+        print
+        print "Not comparing with %s, which differs in %s" % (
+            baseline, ", ".join("%s (%s, now %s)" % (key, saved.get(key),
+                                                     env[key])
+                                for key in different))
+        return 0
+    worse = compare(results, saved["results"], args.tolerance)
+    if worse:
+        print
+        print "%d benchmark(s) worse than the baseline" % len(worse)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
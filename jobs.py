@@ -0,0 +1,187 @@
+"""Trace jobs that run in the background, on a pool of processes.
+
+A job traces n rays from each source of a system, split into chunks
+like OpticalSystem.trace does, and merges the footprints from each
+chunk as they come in. Progress can be followed while it runs.
+
+The system is pickled to a temporary file once per job, and each
+worker process loads it from there the first time it gets a chunk of
+the job, so that it is not sent along with every chunk.
+"""
+
+from collections import OrderedDict
+from itertools import count
+from multiprocessing import Pool, cpu_count
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from traceback import format_exc
+import cPickle as pickle
+import os
+
+import numpy as np
+
+from phoray.losses import Losses
+
+
+# Systems unpickled in a worker process, by job id
+_systems = OrderedDict()
+
+
+def _run_chunk(task):
+    """Trace one chunk of a job, in a worker process. Returns the number
+    of rays traced and lost, and the footprint and loss counts of each
+    element."""
+    job_id, path, index, n, chunk = task
+    try:
+        system = _systems.get(job_id)
+        if system is None:
+            with open(path, "rb") as f:
+                system = _systems[job_id] = pickle.load(f)
+            while len(_systems) > 4:
+                _systems.popitem(last=False)
+        result, footprints = system._trace_chunk(index, n, chunk)
+        lost = n - np.count_nonzero(result.rays[-1].alive)
+        return n, lost, footprints, system.losses(), None
+    except Exception:
+        return n, 0, None, None, format_exc()
+
+
+def _save_system(system):
+    """Pickle a system to a temporary file, leaving out the footprints
+    of earlier traces. Returns the name of the file."""
+    footprints = [element.footprint for element in system.elements]
+    fd, path = mkstemp(prefix="phoray-job-", suffix=".pickle")
+    try:
+        for element in system.elements:
+            element.footprint = element.new_footprint()
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(system, f, pickle.HIGHEST_PROTOCOL)
+        return path
+    finally:
+        for element, footprint in zip(system.elements, footprints):
+            element.footprint = footprint
+
+
+class TraceJob(object):
+
+    """A trace running in the background. The footprints are merged
+    from the chunks as they finish."""
+
+    def __init__(self, id, system, n, chunk_size):
+        self.id = id
+        self.n = n
+        self.chunk_size = chunk_size
+        # (source index, number of rays, chunk) for each chunk
+        self.tasks = [(i, min(chunk_size, n - start), chunk)
+                      for i in xrange(len(system.sources))
+                      for chunk, start in enumerate(xrange(0, n, chunk_size))]
+        self.footprints = [element.new_footprint()
+                           for element in system.elements]
+        self.footprint_modes = [element.footprint_mode
+                                for element in system.elements]
+        self.losses = [Losses() for element in system.elements]
+        self.rays = n * len(system.sources)
+        self.rays_done = self.rays_lost = 0
+        self.chunks_done = 0
+        self.status = "running" if self.tasks else "done"
+        self.error = None
+        self.started = time()
+        self.finished = None if self.tasks else self.started
+        # The pickled system, while the job needs it
+        self.system_file = None
+        self._lock = Lock()
+
+    def _finish(self, status):
+        self.status = status
+        self.finished = time()
+        if self.system_file is not None:
+            os.remove(self.system_file)
+            self.system_file = None
+
+    def _chunk_done(self, result):
+        """Called (in a thread of the pool) when a chunk is finished."""
+        n, lost, footprints, losses, error = result
+        with self._lock:
+            if self.status != "running":
+                return
+            if error is not None:
+                self.error = error
+                self._finish("failed")
+                return
+            for total, footprint in zip(self.footprints, footprints):
+                total.merge(footprint)
+            for total, counts in zip(self.losses, losses):
+                total.merge(counts)
+            self.rays_done += n
+            self.rays_lost += lost
+            self.chunks_done += 1
+            if self.chunks_done == len(self.tasks):
+                self._finish("done")
+
+    def progress(self):
+        """The state of the job. losses has the loss counts of each
+        element so far."""
+        with self._lock:
+            elapsed = (self.finished or time()) - self.started
+            if self.status == "running" and self.rays_done:
+                eta = elapsed * (self.rays - self.rays_done) / self.rays_done
+            else:
+                eta = None
+            return dict(id=self.id, status=self.status, rays=self.rays,
+                        rays_done=self.rays_done, rays_lost=self.rays_lost,
+                        elapsed=elapsed, eta=eta, error=self.error,
+                        losses=[dict(losses) for losses in self.losses])
+
+    def result(self):
+        """The footprint on each element, as in /footprint."""
+        with self._lock:
+            return [{"histogram": footprint.to_dict()}
+                    if mode == "histogram" else
+                    {"footprint": footprint.to_dict()}
+                    for footprint, mode in zip(self.footprints,
+                                               self.footprint_modes)]
+
+
+class JobQueue(object):
+
+    """Runs TraceJobs on a shared pool of worker processes. The pool is
+    only started when the first job is submitted. Only the last
+    max_jobs jobs are remembered."""
+
+    def __init__(self, workers=None, max_jobs=100):
+        self.workers = workers or cpu_count()
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._ids = count(1)
+        self._pool = None
+
+    def submit(self, system, n, chunk_size=10000):
+        """Start tracing n rays from each source of the system.
+        Returns the TraceJob."""
+        if self._pool is None:
+            self._pool = Pool(self.workers)
+        job = TraceJob(next(self._ids), system, n, chunk_size)
+        if job.tasks:
+            job.system_file = _save_system(system)
+        for task in job.tasks:
+            self._pool.apply_async(_run_chunk,
+                                   ((job.id, job.system_file) + task,),
+                                   callback=job._chunk_done)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+        return job
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for job in self.jobs.values():
+            if job.system_file is not None:
+                os.remove(job.system_file)
+                job.system_file = None
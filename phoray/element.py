@@ -1,22 +1,47 @@
 from __future__ import division
 from math import *
-from collections import defaultdict
+import numpy as np
 
+from footprint import Footprint, Histogram
+from losses import Losses
 from member import Member
 from surface import Surface
 from minivec import Vec, Mat
-from ray import Ray
+from ray import Ray, RayBundle
 
 
 class Element(Member):
 
+    # Whether rays of different wavelengths are propagated differently
+    # (see phoray.sweep). Assumed unless a class says otherwise.
+    dispersive = True
+
     def __init__(self,
                  position=Vec(0, 0, 0), rotation=Vec(0, 0, 0),
                  offset=Vec(0, 0, 0), alignment=Vec(0, 0, 0),
-                 geometry=Surface()):
+                 geometry=Surface(), footprint_mode="points", bins=100):
+        """
+        footprint_mode "points" keeps every hit on the element, while
+        "histogram" only keeps a 2D histogram of the hits, with the
+        given number of bins (an int, or (nx, ny) from Python)
+        covering the size of the geometry.
+        """
         self.geometry = geometry
         Member.__init__(self, position, rotation, offset, alignment)
-        self.footprint = defaultdict(list)
+        self.footprint_mode = footprint_mode
+        self.bins = bins
+        self.footprint = self.new_footprint()
+        self.losses = Losses()
+
+    def new_footprint(self):
+        """An empty footprint of the kind this element keeps."""
+        if self.footprint_mode == "histogram":
+            w, h = self.geometry.xsize, self.geometry.ysize
+            if w is None or h is None:
+                raise ValueError("A histogram footprint needs a geometry "
+                                 "with finite xsize and ysize")
+            return Histogram(self.bins, ((-w / 2, w / 2), (-h / 2, h / 2)))
+        return Footprint()
 
     def propagate(self, ray, source=0):
         """
@@ -25,21 +50,50 @@ class Element(Member):
         """
         new_ray = self._propagate(ray)
         if new_ray is not None:
-            self.footprint[source].append((new_ray.endpoint.x,
-                                           new_ray.endpoint.y,
-                                           new_ray.wavelength))
+            p = self.localize_vector(new_ray.endpoint)
+            self.footprint.append(source, p.x, p.y, new_ray.wavelength)
         return new_ray
 
+    def propagate_many(self, rays, record=True):
+        """
+        Batch version of propagate; takes a RayBundle in global
+        coordinates and returns the resulting bundle. Rays that are
+        dead, or have no direction (e.g. stopped by a Detector), are
+        left dead. If record is False, the footprint is not updated.
+
+        Only the living rays are passed on to _propagate_many, so that
+        the rays lost here can be counted in self.losses.
+        """
+        alive = rays.alive & ~np.isnan(rays.directions[:, 0])
+        if alive.all():
+            new_rays = self._propagate_many(rays)
+        else:
+            new_rays = rays.copy()
+            new_rays.alive[:] = False
+            new_rays.put(alive, self._propagate_many(rays.subset(alive)))
+        if record:
+            self.footprint.extend_from_bundle(self.localize_many(new_rays))
+        return new_rays
+
+    def _propagate_many(self, rays):
+        """Generic fallback for elements without a batch version,
+        propagating one ray at a time."""
+        return RayBundle.from_rays(
+            [self._propagate(ray) if ray is not None else None
+             for ray in rays.to_rays()], rays.source)
+
 
 class Mirror(Element):
 
     """A mirror reflects incoming rays in its surface."""
 
+    dispersive = False
+
     def _propagate(self, ray):
 
         if ray is not None:
             ray0 = self.localize(ray)
-            reflected_ray = self.geometry.reflect(ray0)
+            reflected_ray = self.geometry.reflect(ray0, self.losses)
             if reflected_ray is None:
                 return None
             else:
@@ -47,6 +101,10 @@ class Mirror(Element):
         else:
             return None
 
+    def _propagate_many(self, rays):
+        return self.globalize_many(
+            self.geometry.reflect_many(self.localize_many(rays), self.losses))
+
 
 class Detector(Element):
 
@@ -54,14 +112,25 @@ class Detector(Element):
     be the final element in a system.
     """
 
+    dispersive = False
+
     def _propagate(self, ray):
         if ray is not None:
             ray0 = self.localize(ray)
-            pos = self.globalize_vector(self.geometry.intersect(ray0))
-            return Ray(pos, None, ray.wavelength)
+            pos = self.geometry.intersect(ray0, self.losses)
+            if pos is None:
+                return None
+            return Ray(self.globalize_vector(pos), None, ray.wavelength)
         else:
             return None
 
+    def _propagate_many(self, rays):
+        rays0 = self.localize_many(rays)
+        p, hit = self.geometry.intersect_many(rays0.endpoints,
+                                              rays0.directions, self.losses)
+        return RayBundle(self.globalize_vectors(p), np.nan, rays.wavelengths,
+                         rays.alive & hit, rays.source)
+
 
 class Screen(Element):
 
@@ -70,10 +139,21 @@ class Screen(Element):
     intersection of a beam.
     """
 
+    dispersive = False
+
     def _propagate(self, ray):
         ray0 = self.localize(ray)
-        p = self.globalize_vector(self.geometry.intersect(ray0))
-        return Ray(p, ray.direction, ray.wavelength)
+        p = self.geometry.intersect(ray0, self.losses)
+        if p is None:
+            return None
+        return Ray(self.globalize_vector(p), ray.direction, ray.wavelength)
+
+    def _propagate_many(self, rays):
+        rays0 = self.localize_many(rays)
+        p, hit = self.geometry.intersect_many(rays0.endpoints,
+                                              rays0.directions, self.losses)
+        return RayBundle(self.globalize_vectors(p), rays.directions,
+                         rays.wavelengths, rays.alive & hit, rays.source)
 
 
 class ReflectiveGrating(Element):
@@ -89,7 +169,6 @@ class ReflectiveGrating(Element):
         """
         self.d = d
         self.order = order
-        print "Mirror", args, kwargs
         Element.__init__(self, *args, **kwargs)
 
     def _propagate(self, ray):
@@ -97,7 +176,7 @@ class ReflectiveGrating(Element):
         if ray is not None:
             ray0 = self.localize(ray)
             diffracted_ray = self.geometry.diffract(
-                ray0, self.d, self.order)
+                ray0, self.d, self.order, losses=self.losses)
             if diffracted_ray is None:
                 return None
             else:
@@ -105,11 +184,18 @@ class ReflectiveGrating(Element):
         else:
             return None
 
+    def _propagate_many(self, rays):
+        return self.globalize_many(self.geometry.diffract_many(
+            self.localize_many(rays), self.d, self.order,
+            losses=self.losses))
+
 
 class ReflectiveVLSGrating(Mirror):
 
     """A grating with varying line spacing. Not complete."""
 
+    dispersive = True
+
     def __init__(self, an=1.0, *args, **kwargs):
         self.an = an
         Mirror.__init__(self, *args, **kwargs)
@@ -128,7 +214,6 @@ class ReflectiveVLSGrating(Mirror):
         #x=y
         b = -x / sqrt(R ** 2 - x ** 2)
         theta = atan(b)  # grating tangent angle
-        print b, theta
         d = 0
         for n, a in enumerate(self.an):
             d += a * x ** n
@@ -140,7 +225,8 @@ class ReflectiveVLSGrating(Mirror):
         if ray is not None:
             ray0 = self.localize(ray)
             diffracted_ray = self.geometry.diffract(ray0, None, self.order,
-                                                    self.get_line_distance)
+                                                    self.get_line_distance,
+                                                    self.losses)
             if diffracted_ray is None:
                 return None
             else:
@@ -148,11 +234,18 @@ class ReflectiveVLSGrating(Mirror):
         else:
             return None
 
+    def _propagate_many(self, rays):
+        return self.globalize_many(self.geometry.diffract_many(
+            self.localize_many(rays), None, self.order,
+            self.get_line_distance, self.losses))
+
 
 class Glass(Element):
 
     """A glass surface, defined by the refraction indices on each side."""
 
+    dispersive = False
+
     def __init__(self, index1=1.0, index2=1.0, *args, **kwargs):
         self.index1 = index1
         self.index2 = index2
@@ -163,10 +256,14 @@ class Glass(Element):
         if ray is not None:
             ray0 = self.localize(ray)
             refracted_ray = self.geometry.refract(ray0, self.index1,
-                                                  self.index2)
+                                                  self.index2, self.losses)
             if refracted_ray is None:
                 return None
             else:
                 return self.globalize(refracted_ray)
         else:
             return None
+
+    def _propagate_many(self, rays):
+        return self.globalize_many(self.geometry.refract_many(
+            self.localize_many(rays), self.index1, self.index2, self.losses))
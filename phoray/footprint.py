@@ -0,0 +1,182 @@
+"""Stores for the hits recorded on an element (its "footprint")."""
+
+from __future__ import division
+
+import numpy as np
+
+
+class BaseFootprint(object):
+
+    """What Footprint and Histogram have in common. Subclasses
+    implement extend()."""
+
+    def extend_from_bundle(self, rays):
+        """Record the living rays of a RayBundle, whose endpoints
+        should be in the element's local coordinates."""
+        alive = rays.alive
+        sources = rays.source[alive]
+        points = rays.endpoints[alive]
+        wavelengths = rays.wavelengths[alive]
+        for source in np.unique(sources).tolist():
+            sel = sources == source
+            self.extend(source, points[sel, 0], points[sel, 1],
+                        wavelengths[sel])
+
+
+class Footprint(BaseFootprint):
+
+    """
+    Records the hits on an element, per source, as (x, y, wavelength)
+    rows in the element's local coordinate system. Each source gets a
+    preallocated array that grows by doubling, so appending is cheap
+    and the data is always available as arrays without copying.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        """Forget all recorded hits."""
+        self._data = {}
+        self._count = {}
+
+    def _reserve(self, source, n):
+        """Make room for n more hits from source, returning the start."""
+        count = self._count.get(source, 0)
+        data = self._data.get(source)
+        if data is None or count + n > len(data):
+            size = max(self.capacity, 2 * (count + n))
+            new = np.empty((size, 3))
+            if data is not None:
+                new[:count] = data[:count]
+            self._data[source] = data = new
+        self._count[source] = count + n
+        return count
+
+    def append(self, source, x, y, wavelength):
+        """Record a single hit."""
+        i = self._reserve(source, 1)
+        self._data[source][i] = x, y, wavelength
+
+    def extend(self, source, x, y, wavelengths):
+        """Record many hits from one source, given as arrays."""
+        n = len(x)
+        if n:
+            i = self._reserve(source, n)
+            data = self._data[source]
+            data[i:i + n, 0] = x
+            data[i:i + n, 1] = y
+            data[i:i + n, 2] = wavelengths
+
+    def merge(self, other):
+        """Add all the hits recorded in another Footprint."""
+        for source in other.sources():
+            data = other[source]
+            self.extend(source, data[:, 0], data[:, 1], data[:, 2])
+
+    def sources(self):
+        return sorted(self._count)
+
+    def __getitem__(self, source):
+        """The (N, 3) array of x, y, wavelength for the given source."""
+        if source not in self._count:
+            return np.empty((0, 3))
+        return self._data[source][:self._count[source]]
+
+    def __len__(self):
+        return sum(self._count.values())
+
+    def as_arrays(self):
+        """A dict of (N, 3) arrays of x, y, wavelength, per source."""
+        return dict((source, self[source]) for source in self._count)
+
+    def to_dict(self):
+        """The footprint as plain lists, e.g. for JSON encoding."""
+        return dict((source, self[source].tolist())
+                    for source in self._count)
+
+
+class Histogram(BaseFootprint):
+
+    """
+    A footprint that only keeps a 2D histogram of the hits, one per
+    source and wavelength, so that memory use does not grow with the
+    number of rays. Has the same interface as Footprint.
+
+    bins is the number of bins, either one number or (nx, ny), and
+    range ((xmin, xmax), (ymin, ymax)) the area covered. Hits outside
+    are not counted.
+    """
+
+    def __init__(self, bins, range):
+        if isinstance(bins, int):
+            bins = (bins, bins)
+        self.bins = tuple(bins)
+        self.range = tuple(tuple(r) for r in range)
+        self.clear()
+
+    def clear(self):
+        self._counts = {}
+
+    def append(self, source, x, y, wavelength):
+        self.extend(source, np.array([x]), np.array([y]),
+                    np.array([wavelength]))
+
+    def extend(self, source, x, y, wavelengths):
+        (x0, x1), (y0, y1) = self.range
+        nx, ny = self.bins
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        x, y, wavelengths = x[inside], y[inside], wavelengths[inside]
+        # the upper edge belongs to the last bin, as in numpy.histogram2d
+        ix = np.minimum(np.floor((x - x0) * (nx / (x1 - x0))), nx - 1)
+        iy = np.minimum(np.floor((y - y0) * (ny / (y1 - y0))), ny - 1)
+        index = (ix * ny + iy).astype(int)
+        for wavelength in np.unique(wavelengths).tolist():
+            counts = self._counts.get((source, wavelength))
+            if counts is None:
+                counts = self._counts[source, wavelength] = np.zeros(
+                    self.bins, dtype=np.int64)
+            sel = index[wavelengths == wavelength]
+            counts += np.bincount(sel, minlength=nx * ny).reshape(self.bins)
+
+    def merge(self, other):
+        """Add the counts of another Histogram with the same bins."""
+        for (source, wavelength), counts in other._counts.items():
+            self.add_counts(source, wavelength, counts)
+
+    def add_counts(self, source, wavelength, counts):
+        """Add an (nx, ny) array of counts for the source and
+        wavelength, e.g. from as_arrays() of another Histogram."""
+        key = source, wavelength
+        if key in self._counts:
+            self._counts[key] += counts
+        else:
+            self._counts[key] = np.array(counts, dtype=np.int64)
+
+    def sources(self):
+        return sorted(set(source for source, wavelength in self._counts))
+
+    def __getitem__(self, source):
+        """The summed histogram of all wavelengths from the source."""
+        total = np.zeros(self.bins, dtype=np.int64)
+        for (s, wavelength), counts in self._counts.items():
+            if s == source:
+                total += counts
+        return total
+
+    def __len__(self):
+        return int(sum(counts.sum() for counts in self._counts.values()))
+
+    def as_arrays(self):
+        """A dict of the (nx, ny) count arrays, per (source, wavelength)."""
+        return dict(self._counts)
+
+    def to_dict(self):
+        """The histograms as plain lists, e.g. for JSON encoding."""
+        histograms = {}
+        for (source, wavelength), counts in sorted(self._counts.items()):
+            histograms.setdefault(source, []).append(
+                dict(wavelength=wavelength, counts=counts.tolist()))
+        return dict(bins=self.bins, range=self.range,
+                    histograms=histograms)
@@ -0,0 +1,42 @@
+"""Counting of the rays lost on an element, by cause."""
+
+import numpy as np
+
+
+# The ways a ray can be lost
+KINDS = ("missed",      # does not intersect the surface at all
+         "outside",     # intersects it outside the aperture
+         "backlit",     # comes from behind
+         "evanescent",  # the diffraction order does not propagate
+         "tir")         # total internal reflection
+
+
+class Losses(dict):
+
+    """The number of lost rays of each kind (see KINDS)."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.clear()
+
+    def clear(self):
+        self.update(dict.fromkeys(KINDS, 0))
+
+    def add(self, kind, lost):
+        """Count lost rays; lost is either a number or a boolean mask."""
+        if isinstance(lost, np.ndarray):
+            lost = int(np.count_nonzero(lost))
+        self[kind] += lost
+
+    def merge(self, other):
+        for kind, count in other.items():
+            self[kind] += count
+
+    def total(self):
+        return sum(self.values())
+
+
+def count_losses(losses, kind, lost=1):
+    """Add to the given Losses, unless it is None."""
+    if losses is not None:
+        losses.add(kind, lost)
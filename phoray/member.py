@@ -1,26 +1,48 @@
 from __future__ import division
 from math import *
 
+import numpy as np
+
 from minivec import Vec, Mat
-from ray import Ray
+from ray import Ray, RayBundle
+
+
+def _placement(name):
+    """A Vec attribute that recalculates the transformation matrices
+    when it is changed (once they have first been calculated)."""
+    attr = "_" + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        setattr(self, attr, Vec(value))
+        if hasattr(self, "_matrices"):
+            self.precalc()
+
+    return property(get, set)
 
 
 class Member(object):
 
     """Baseclass for a generalized member of an optical system."""
 
+    position = _placement("position")
+    rotation = _placement("rotation")
+    offset = _placement("offset")
+    alignment = _placement("alignment")
+
     def __init__(self, position=Vec(0, 0, 0), rotation=Vec(0, 0, 0),
                  offset=Vec(0, 0, 0), alignment=Vec(0, 0, 0)):
 
-        self.position = Vec(position)
-        self.rotation = Vec(rotation)
+        self.position = position
+        self.rotation = rotation
 
-        self.offset = Vec(offset)
-        self.alignment = Vec(alignment)
+        self.offset = offset
+        self.alignment = alignment
 
-        # Precalculate some matrices. Note that this means that the
-        # element can't be moved after creation, unless precalc is
-        # called again afterwards.
+        # Precalculate the transformation matrices. Changing the
+        # placement afterwards calculates them again.
         self.precalc()
 
     def precalc(self):
@@ -34,6 +56,10 @@ class Member(object):
             .translate(self.offset).transform(self._rotate)\
             .translate(self.position)
 
+        # numpy versions of the same, for the batch methods
+        self._matrices = (np.reshape(tuple(self._matloc), (4, 4)),
+                          np.reshape(tuple(self._matglob), (4, 4)))
+
     def localize_vector(self, v):
         #return (((v - self.position).transform(self._rotate.invert()) -
         #        self.offset).transform(self._align.invert()))
@@ -52,6 +78,23 @@ class Member(object):
                    self.localize_direction(ray.direction),
                    ray.wavelength)
 
+    def localize_vectors(self, points):
+        """Transform an (N, 3) array of points into local coordinates."""
+        m = self._matrices[0]
+        return np.dot(points, m[:3, :3]) + m[3, :3]
+
+    def localize_directions(self, directions):
+        """Transform an (N, 3) array of directions into local coordinates."""
+        return np.dot(directions, self._matrices[0][:3, :3])
+
+    def localize_many(self, rays):
+        """
+        Transform a RayBundle in global coordinates into local coordinates
+        """
+        return RayBundle(self.localize_vectors(rays.endpoints),
+                         self.localize_directions(rays.directions),
+                         rays.wavelengths, rays.alive, rays.source)
+
     def globalize_vector(self, v):
         #return ((v.transform(self._align) + self.offset).transform(
         #        self._rotate) + self.position)
@@ -68,3 +111,22 @@ class Member(object):
         return Ray(self.globalize_vector(ray.endpoint),
                    self.globalize_direction(ray.direction),
                    ray.wavelength)
+
+    def globalize_vectors(self, points):
+        """Transform an (N, 3) array of local points into global
+        coordinates."""
+        m = self._matrices[1]
+        return np.dot(points, m[:3, :3]) + m[3, :3]
+
+    def globalize_directions(self, directions):
+        """Transform an (N, 3) array of local directions into global
+        coordinates."""
+        return np.dot(directions, self._matrices[1][:3, :3])
+
+    def globalize_many(self, rays):
+        """
+        Transform a local RayBundle into global coordinates
+        """
+        return RayBundle(self.globalize_vectors(rays.endpoints),
+                         self.globalize_directions(rays.directions),
+                         rays.wavelengths, rays.alive, rays.source)
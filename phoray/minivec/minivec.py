@@ -57,6 +57,13 @@ _Deg = degrees(1.0)
 _DefaultError = 0.0
 _DefaultEpsilon = 1e-8
 
+# Rotations are often made with the same angles over and over (e.g. the
+# 90 degree rotation in grating directions), so the trigonometry is
+# memoized. The memos are simply emptied when they reach _MemoSize.
+_MemoSize = 1024
+_SinCosMemo = {}
+_RotateMemo = {}
+
 
 class Vec(object):
     """Immutable vector class for linear algebra.
@@ -84,6 +91,17 @@ class Vec(object):
         self.__vec = _Triplet(vec, allowNone=True)
 
 
+    @classmethod
+    def _from_floats(cls, x, y, z):
+        """Create a vector directly from three floats, skipping the
+        argument checks. Only for internal use, where the values are
+        known to be floats already.
+        """
+        vec = object.__new__(cls)
+        vec.__vec = (x, y, z)
+        return vec
+
+
     @classmethod
     def Error(cls, reason="Invalid Vector"):
         """Create a new vector that represents an error.
@@ -192,7 +210,7 @@ class Vec(object):
             return Vec.Error("Cannot normalize zero length vector")
         selfLength = selfX * selfX + selfY * selfY + selfZ * selfZ
         mult = length / sqrt(selfLength)
-        return type(self)((selfX * mult, selfY * mult, selfZ * mult))
+        return self._from_floats(selfX * mult, selfY * mult, selfZ * mult)
 
 
     def reflect(self, *vec):
@@ -229,7 +247,7 @@ class Vec(object):
         """
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(vec)
-        return type(self)((selfY * otherZ - selfZ * otherY, selfZ * otherX - selfX * otherZ, selfX * otherY - selfY * otherX))
+        return self._from_floats(selfY * otherZ - selfZ * otherY, selfZ * otherX - selfX * otherZ, selfX * otherY - selfY * otherX)
 
 
     def dot(self, *vec):
@@ -259,7 +277,7 @@ class Vec(object):
 
     def __neg__(self):
         selfX, selfY, selfZ = self.__vec
-        return type(self)((-selfX, -selfY, -selfZ))
+        return self._from_floats(-selfX, -selfY, -selfZ)
 
 
     def __pos__(self):
@@ -284,7 +302,7 @@ class Vec(object):
     def __add__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX + otherX, selfY + otherY, selfZ + otherZ))
+        return self._from_floats(selfX + otherX, selfY + otherY, selfZ + otherZ)
 
     __radd__ = __add__
 
@@ -292,19 +310,19 @@ class Vec(object):
     def __sub__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX - otherX, selfY - otherY, selfZ - otherZ))
+        return self._from_floats(selfX - otherX, selfY - otherY, selfZ - otherZ)
 
 
     def __rsub__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((otherX - selfX, otherY - selfY, otherZ - selfZ))
+        return self._from_floats(otherX - selfX, otherY - selfY, otherZ - selfZ)
 
 
     def __mul__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX * otherX, selfY * otherY, selfZ * otherZ))
+        return self._from_floats(selfX * otherX, selfY * otherY, selfZ * otherZ)
 
     __rmul__ = __mul__
 
@@ -313,13 +331,13 @@ class Vec(object):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
 
-        return type(self)((otherX and selfX / otherX, otherY and selfY / otherY, otherX and selfZ / otherZ))
+        return self._from_floats(otherX and selfX / otherX, otherY and selfY / otherY, otherX and selfZ / otherZ)
 
 
     def __rdiv__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX and otherX / selfX, selfY and otherY / selfY, selfZ and otherZ / selfZ))
+        return self._from_floats(selfX and otherX / selfX, selfY and otherY / selfY, selfZ and otherZ / selfZ)
 
     __truediv__ = __div__
     __rtruediv__ = __rdiv__
@@ -328,13 +346,13 @@ class Vec(object):
     def __floordiv__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((otherX and selfX // otherX, otherY and selfY // otherY, otherZ and selfZ // otherZ))
+        return self._from_floats(otherX and selfX // otherX, otherY and selfY // otherY, otherZ and selfZ // otherZ)
 
 
     def __rfloordiv__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX and otherX // selfX, selfY and otherY // selfY, selfZ and otherZ // selfZ))
+        return self._from_floats(selfX and otherX // selfX, selfY and otherY // selfY, selfZ and otherZ // selfZ)
 
 
     def __pow__(self, other, modulo=None):
@@ -342,13 +360,13 @@ class Vec(object):
             raise NotImplementedError("Vector cannot use modulo power operator")
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((selfX ** otherX, selfY ** otherY, selfZ ** otherZ))
+        return self._from_floats(selfX ** otherX, selfY ** otherY, selfZ ** otherZ)
 
 
     def __rpow__(self, other):
         selfX, selfY, selfZ = self.__vec
         otherX, otherY, otherZ = _Triplet(other, allowNested=False)
-        return type(self)((otherX ** selfX, otherY ** selfY, otherZ ** selfZ))
+        return self._from_floats(otherX ** selfX, otherY ** selfY, otherZ ** selfZ)
 
     __xor__ = dot
     __rxor__ = dot
@@ -365,7 +383,7 @@ class Vec(object):
         diffX = (otherX - selfX) * percent
         diffY = (otherY - selfY) * percent
         diffZ = (otherZ - selfZ) * percent
-        return type(self)(selfX + diffX, selfY + diffY, selfZ + diffZ)
+        return self._from_floats(selfX + diffX, selfY + diffY, selfZ + diffZ)
 
 
     def swizzle(self, lookup):
@@ -410,7 +428,7 @@ class Vec(object):
             rx /= rw
             ry /= rw
             rz /= rw
-        return type(self)(rx, ry, rz)
+        return self._from_floats(rx, ry, rz)
 
 
     def transformDir(self, matrix):
@@ -422,7 +440,7 @@ class Vec(object):
         rx = selfX * sa + selfY * se + selfZ * si
         ry = selfX * sb + selfY * sf + selfZ * sj
         rz = selfX * sc + selfY * sg + selfZ * sk
-        return type(self)(rx, ry, rz)
+        return self._from_floats(rx, ry, rz)
 
 
     def contains(self, other):
@@ -509,6 +527,16 @@ class Mat(object):
         self.__mat = _Sixteenlet(matrix, allowNone=True)
 
 
+    @classmethod
+    def _from_floats(cls, values):
+        """Create a matrix directly from a tuple of sixteen floats,
+        skipping the argument checks. Only for internal use.
+        """
+        mat = object.__new__(cls)
+        mat.__mat = values
+        return mat
+
+
     @classmethod
     def Error(cls, reason="Invalid Mat"):
         global _ThreadLocal
@@ -560,12 +588,12 @@ class Mat(object):
         """Generate a new matrix that has the columns swapped for rows.
         """
         sa, sb, sc, sd,  se, sf, sg, sh,  si, sj, sk, sl,  sm, sn, so, sp = self.__mat
-        return type(self)((sa, se, si, sm,  sb, sf, sj, sn,  sc, sg, sk, so,  sd, sh, sl, sp))
+        return self._from_floats((sa, se, si, sm,  sb, sf, sj, sn,  sc, sg, sk, so,  sd, sh, sl, sp))
 
 
     def __neg__(self):
         sa, sb, sc, sd,  se, sf, sg, sh,  si, sj, sk, sl,  sm, sn, so, sp = self.__mat
-        return type(self)((-sa, -sb, -sc, -sd,  -se, -sf, -sg, -sh,  -si, -sj, -sk, -sl,  -sm, -sn, -so, -sp))
+        return self._from_floats((-sa, -sb, -sc, -sd,  -se, -sf, -sg, -sh,  -si, -sj, -sk, -sl,  -sm, -sn, -so, -sp))
 
 
     def __pos__(self):
@@ -639,7 +667,7 @@ class Mat(object):
         ro = sm * oc + sn * og + so * ok + sp * oo
         rp = sm * od + sn * oh + so * ol + sp * op
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     __mul__ = transform
@@ -669,7 +697,7 @@ class Mat(object):
         ro = sm * oc + sn * og + so * ok + sp * oo
         rp = sm * od + sn * oh + so * ol + sp * op
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     def scale(self, *vec):
@@ -681,7 +709,7 @@ class Mat(object):
         re = se * y; rf = sf * y; rg = sg * y; rh = sh * y
         ri = si * z; rj = sj * z; rk = sk * z; rl = sl * z
         rm = sm; rn = sn; ro = so; rp = sp
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
 
@@ -711,7 +739,7 @@ class Mat(object):
         ro = so + sp * z
         rp = sp
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     def shear(self, *vec):
@@ -748,37 +776,46 @@ class Mat(object):
         ro = so
         rp = sp
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     def rotate(self, *vec):
         """XYZ order"""
 
         sa, sb, sc, sd,  se, sf, sg, sh,  si, sj, sk, sl,  sm, sn, so, sp = self.__mat
-        x, y, z = _Triplet(vec)
-        x *= _Rad; y *= _Rad; z *= _Rad
-        a = cos(x); c = cos(y); e = cos(z)
-        b = sin(x); d = sin(y); f = sin(z)
-
-        ae = a * e
-        af = a * f
-        be = b * e
-        bf = b * f
-
-        o0 = c * e
-        o4 = - c * f
-        o8 = d
-
-        o1 = af + be * d
-        o5 = ae - bf * d
-        o9 = - b * c
-
-        o2 = bf - ae * d
-        o6 = be + af * d
-        o10 = a * c
-
-        return type(self)((o0, o1, o2, sd, o4, o5, o6, sh,
-                           o8, o9, o10, sl, sm, sn, so, sp))
+        key = _Triplet(vec)
+        rotation = _RotateMemo.get(key)
+        if rotation is None:
+            x, y, z = key
+            x *= _Rad; y *= _Rad; z *= _Rad
+            a = cos(x); c = cos(y); e = cos(z)
+            b = sin(x); d = sin(y); f = sin(z)
+
+            ae = a * e
+            af = a * f
+            be = b * e
+            bf = b * f
+
+            o0 = c * e
+            o4 = - c * f
+            o8 = d
+
+            o1 = af + be * d
+            o5 = ae - bf * d
+            o9 = - b * c
+
+            o2 = bf - ae * d
+            o6 = be + af * d
+            o10 = a * c
+
+            rotation = (o0, o1, o2, o4, o5, o6, o8, o9, o10)
+            if len(_RotateMemo) >= _MemoSize:
+                _RotateMemo.clear()
+            _RotateMemo[key] = rotation
+        o0, o1, o2, o4, o5, o6, o8, o9, o10 = rotation
+
+        return self._from_floats((o0, o1, o2, sd, o4, o5, o6, sh,
+                                  o8, o9, o10, sl, sm, sn, so, sp))
 
     def _rotate(self, *vec):
         """ZYX order"""
@@ -810,10 +847,10 @@ class Mat(object):
         o6 = b
         o10 = a * c
 
-        return type(self)((o0, o1, o2, sd,
-                           o4, o5, o6, sh,
-                           o8, o9, o10, sl,
-                           sm, sn, so, sp))
+        return self._from_floats((o0, o1, o2, sd,
+                                  o4, o5, o6, sh,
+                                  o8, o9, o10, sl,
+                                  sm, sn, so, sp))
 
 
     def __rotate(self, *vec):
@@ -858,7 +895,7 @@ class Mat(object):
         ro = sm * oc + sn * og + so * ok
         rp = sp
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     def rotateAxis(self, angle, *axis):
@@ -872,10 +909,7 @@ class Mat(object):
             return type(self)(0.0)
 
         ax, ay, az = axisVec.normalize()
-        angle *= _Rad
-
-        s = sin(angle)
-        c = cos(angle)
+        s, c = _SinCos(angle)
         nc = 1.0 - c
 
         m00 = ax * ax * nc + c
@@ -904,7 +938,7 @@ class Mat(object):
         rl = sd * m20 + sh * m21 + sl * m22
 
         rm = sm; rn = sn; ro = so; rp = sp
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     @classmethod
@@ -988,34 +1022,45 @@ class Mat(object):
         """
         Create a matrix rotated around an axis in degrees.
         """
-        ax, ay, az = Vec(*axis).normalize()
-        angle *= _Rad
+        s, c = _SinCos(angle)
+        return cls._FromAxisSinCos(Vec(*axis).normalize(), s, c)
+
 
-        s = sin(angle)
-        c = cos(angle)
+    @classmethod
+    def RotateAxisRadians(cls, angle, *axis):
+        """
+        Create a matrix rotated around an axis in radians.
+        """
+        return cls._FromAxisSinCos(Vec(*axis).normalize(),
+                                   sin(angle), cos(angle))
+
+
+    @classmethod
+    def _FromAxisSinCos(cls, axis, s, c):
+        ax, ay, az = axis
         nc = 1.0 - c
 
         ra = ax * ax * nc + c
         rb = ax * ay * nc + az * s
         rc = ax * az * nc - ay * s
-        rd = 0
+        rd = 0.0
 
         re = ax * ay * nc - az * s
         rf = ay * ay * nc + c
         rg = ay * az * nc + ax * s
-        rh = 0
+        rh = 0.0
 
         ri = ax * az * nc + ay * s
         rj = ay * az * nc - ax * s
         rk = az * az * nc + c
-        rl = 0
+        rl = 0.0
 
-        rm = 0
-        rn = 0
-        ro = 0
-        rp = 1
+        rm = 0.0
+        rn = 0.0
+        ro = 0.0
+        rp = 1.0
 
-        return cls((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return cls._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     def invert(self):
@@ -1060,7 +1105,7 @@ class Mat(object):
         rl = di * (sd * (si * sf - se * sj) + sh * (sa * sj - si * sb) + sl * (se * sb - sa * sf))
         rp = di * (sa * (sf * sk - sj * sg) + se * (sj * sc - sb * sk) + si * (sb * sg - sf * sc))
 
-        return type(self)((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
+        return self._from_floats((ra, rb, rc, rd,  re, rf, rg, rh,  ri, rj, rk, rl,  rm, rn, ro, rp))
 
 
     __invert__ = invert   # This is the ~ unary operator
@@ -1530,9 +1575,27 @@ class _ErrorPopContext(object):
         return "_ErrorPopContext()"
 
 
+def _SinCos(angle):
+    """The sine and cosine of an angle in degrees, memoized."""
+    sinCos = _SinCosMemo.get(angle)
+    if sinCos is None:
+        if len(_SinCosMemo) >= _MemoSize:
+            _SinCosMemo.clear()
+        angle2 = angle * _Rad
+        sinCos = _SinCosMemo[angle] = (sin(angle2), cos(angle2))
+    return sinCos
+
+
+
 def _Triplet(obj, allowNone=False, allowNested=True, allowScalar=True):
-    if Vec in obj.__class__.__mro__:
-        return tuple(obj)
+    # Fast paths for the common cases of a Vec, or a Vec as the only
+    # argument, whose values are already checked
+    mro = obj.__class__.__mro__
+    if Vec in mro:
+        return obj._Vec__vec
+    if allowNested and tuple in mro and len(obj) == 1 and \
+            Vec in obj[0].__class__.__mro__:
+        return obj[0]._Vec__vec
     num, seq = _FloatOrSequence(obj, iterMax=4)
     if num is not None:
         if allowScalar:
@@ -1561,8 +1624,12 @@ def _Quadlet(obj):
 
 
 def _Sixteenlet(obj, allowNone=False, allowNested=True, allowScalar=True):
-    if Mat in obj.__class__.__mro__:
-        return tuple(obj)
+    mro = obj.__class__.__mro__
+    if Mat in mro:
+        return obj._Mat__mat
+    if allowNested and tuple in mro and len(obj) == 1 and \
+            Mat in obj[0].__class__.__mro__:
+        return obj[0]._Mat__mat
     num, seq = _FloatOrSequence(obj, iterMax=17)
     if num is not None:
         if allowScalar:
@@ -1,4 +1,7 @@
 from __future__ import division
+
+import numpy as np
+
 from minivec import Vec, Mat
 
 
@@ -39,3 +42,175 @@ class Ray(object):
     def along(self, dist):
         """Return a position along the ray."""
         return self.endpoint + self.direction * dist
+
+
+def rotation_matrices(angles):
+    """
+    Rotation matrices for an (N, 3) array of XYZ euler angles in
+    degrees, as an (N, 3, 3) array. Same convention as Mat().rotate,
+    i.e. a direction d is rotated by d.dot(R).
+    """
+    x, y, z = np.radians(np.asarray(angles, dtype=float)).T
+    a, c, e = np.cos(x), np.cos(y), np.cos(z)
+    b, d, f = np.sin(x), np.sin(y), np.sin(z)
+    R = np.empty((len(x), 3, 3))
+    R[:, 0, 0] = c * e
+    R[:, 0, 1] = a * f + b * e * d
+    R[:, 0, 2] = b * f - a * e * d
+    R[:, 1, 0] = -c * f
+    R[:, 1, 1] = a * e - b * f * d
+    R[:, 1, 2] = b * e + a * f * d
+    R[:, 2, 0] = d
+    R[:, 2, 1] = -b * c
+    R[:, 2, 2] = a * c
+    return R
+
+
+class RayBundle(object):
+    """
+    A bundle of N rays stored as arrays ("structure of arrays"); the
+    batched counterpart of Ray.
+
+    endpoints and directions are (N, 3) float arrays, wavelengths an
+    (N,) float array. alive is a boolean mask of the rays that are
+    still being traced, and source the index of the source each ray
+    came from. Rays without a direction (e.g. stopped by a Detector)
+    have NaN directions.
+    """
+
+    def __init__(self, endpoints, directions, wavelengths=1,
+                 alive=True, source=0):
+        self.endpoints = np.ascontiguousarray(endpoints, dtype=float)
+        n = len(self.endpoints)
+        self.directions = np.ascontiguousarray(directions, dtype=float)
+        if self.directions.shape != self.endpoints.shape:
+            self.directions = np.ascontiguousarray(np.broadcast_to(
+                self.directions, self.endpoints.shape))
+        self.wavelengths = _column(wavelengths, n, float)
+        self.alive = _column(alive, n, bool)
+        self.source = _column(source, n, np.int32)
+
+    @classmethod
+    def empty(cls, n=0):
+        """A bundle of n dead rays, to be filled in."""
+        return cls(np.zeros((n, 3)), np.zeros((n, 3)), 0, False, 0)
+
+    @classmethod
+    def from_rays(cls, rays, source=0):
+        """Create a bundle from a sequence of Rays. None entries (lost
+        rays) become dead rays."""
+        rays = list(rays)
+        n = len(rays)
+        endpoints = np.zeros((n, 3))
+        directions = np.zeros((n, 3))
+        wavelengths = np.zeros(n)
+        alive = np.zeros(n, dtype=bool)
+        for i, ray in enumerate(rays):
+            if ray is None:
+                continue
+            endpoints[i] = tuple(ray.endpoint)
+            directions[i] = (np.nan if ray.direction is None
+                             else tuple(ray.direction))
+            wavelengths[i] = ray.wavelength
+            alive[i] = True
+        return cls(endpoints, directions, wavelengths, alive, source)
+
+    def to_rays(self):
+        """Convert the bundle back into a list of Rays, with None in
+        place of dead rays."""
+        rays = []
+        for p, d, wl, alive in zip(self.endpoints.tolist(),
+                                   self.directions.tolist(),
+                                   self.wavelengths.tolist(),
+                                   self.alive.tolist()):
+            if not alive:
+                rays.append(None)
+                continue
+            direction = None if d[0] != d[0] else Vec(d)  # NaN check
+            rays.append(Ray(Vec(p), direction, wl))
+        return rays
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __repr__(self):
+        return "RayBundle(%d rays, %d alive)" % (len(self), self.count())
+
+    def count(self):
+        """Number of rays still alive."""
+        return int(np.count_nonzero(self.alive))
+
+    def copy(self):
+        return RayBundle(self.endpoints.copy(), self.directions.copy(),
+                         self.wavelengths.copy(), self.alive.copy(),
+                         self.source.copy())
+
+    def subset(self, index):
+        """A new bundle with the rays selected by index (mask or indices)."""
+        return RayBundle(self.endpoints[index], self.directions[index],
+                         self.wavelengths[index], self.alive[index],
+                         self.source[index])
+
+    def put(self, index, rays):
+        """Replace the rays selected by index with the given bundle,
+        in place; the opposite of subset."""
+        self.endpoints[index] = rays.endpoints
+        self.directions[index] = rays.directions
+        self.wavelengths[index] = rays.wavelengths
+        self.alive[index] = rays.alive
+        self.source[index] = rays.source
+
+    @classmethod
+    def concatenate(cls, bundles):
+        bundles = list(bundles)
+        if not bundles:
+            return cls.empty()
+        return cls(np.concatenate([b.endpoints for b in bundles]),
+                   np.concatenate([b.directions for b in bundles]),
+                   np.concatenate([b.wavelengths for b in bundles]),
+                   np.concatenate([b.alive for b in bundles]),
+                   np.concatenate([b.source for b in bundles]))
+
+    def translate(self, v):
+        """Parallel movement of all rays by v, which is either a single
+        vector or an (N, 3) array. Directions are unchanged."""
+        return RayBundle(self.endpoints + _array(v), self.directions,
+                         self.wavelengths, self.alive, self.source)
+
+    def deviate(self, dtheta):
+        """Rotate the directions around the x, y and z axes. dtheta is
+        either one set of angles (degrees) for the whole bundle, or an
+        (N, 3) array with one set per ray.
+        """
+        dtheta = _array(dtheta)
+        if dtheta.ndim == 1:
+            rotation = rotation_matrices(dtheta[np.newaxis])[0]
+            directions = self.directions.dot(rotation)
+        else:
+            rotation = rotation_matrices(dtheta)
+            directions = np.einsum("ni,nij->nj", self.directions, rotation)
+        return RayBundle(self.endpoints, directions, self.wavelengths,
+                         self.alive, self.source)
+
+    def along(self, dist):
+        """Return the positions at distance dist (scalar or (N,) array)
+        along each ray."""
+        dist = np.asarray(dist, dtype=float)
+        if dist.ndim:
+            dist = dist[:, np.newaxis]
+        return self.endpoints + self.directions * dist
+
+
+def _array(v):
+    """A Vec, sequence or array as a float array."""
+    if isinstance(v, Vec):
+        v = tuple(v)
+    return np.asarray(v, dtype=float)
+
+
+def _column(value, n, dtype):
+    """Broadcast a scalar or sequence to a contiguous (n,) array."""
+    value = np.asarray(value, dtype=dtype)
+    if value.ndim == 0:
+        return np.full(n, value, dtype=dtype)
+    return np.ascontiguousarray(value)
@@ -0,0 +1,134 @@
+"""
+Trace a system from the command line, without the server:
+
+    python -m phoray.run spec.json --rays 1e7 --workers 16 --out result.npz
+
+The spec file has the same JSON that the UI posts to /system. The rays
+are traced in parallel, and the footprints saved with numpy.savez:
+
+    element<i>_source<j>    (N, 3) array of x, y, wavelength of the hits
+                            on element i by rays from source j, in the
+                            element's local coordinates
+    element<i>_counts       for elements with a histogram footprint, the
+    element<i>_sources      (K, nx, ny) counts of each (source,
+    element<i>_wavelengths  wavelength) pair, and the area covered
+    element<i>_range
+    losses                  (elements, kinds) counts of lost rays
+    loss_kinds              the names of the kinds of losses
+
+With --sink DIR, the hits are instead written to memory mapped files
+in DIR as they are traced (see phoray.sink), for traces whose
+footprints do not fit in memory.
+
+With --checkpoint FILE, the progress is saved to FILE now and then, and
+an interrupted run can be continued by running it again with --resume.
+"""
+
+from __future__ import absolute_import, division
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+from time import time
+import json
+import os
+import sys
+
+import numpy as np
+
+from phoray.footprint import Histogram
+from phoray.losses import KINDS
+from phoray.sink import TraceSink, MANIFEST
+from phoray.spec import create_system, load_plugins
+
+
+def footprint_arrays(system):
+    """The footprints and loss counts of a system, as a dict of arrays
+    (see above)."""
+    arrays = {}
+    for i, element in enumerate(system.elements):
+        footprint = element.footprint
+        if isinstance(footprint, Histogram):
+            keys = sorted(footprint.as_arrays())
+            arrays["element%d_counts" % i] = np.array(
+                [footprint.as_arrays()[key] for key in keys],
+                dtype=np.int64).reshape((-1,) + footprint.bins)
+            arrays["element%d_sources" % i] = np.array(
+                [source for source, wavelength in keys], dtype=int)
+            arrays["element%d_wavelengths" % i] = np.array(
+                [wavelength for source, wavelength in keys], dtype=float)
+            arrays["element%d_range" % i] = np.array(footprint.range)
+        else:
+            for source in footprint.sources():
+                arrays["element%d_source%d" % (i, source)] = footprint[source]
+    arrays["losses"] = np.array([[losses[kind] for kind in KINDS]
+                                 for losses in system.losses()],
+                                dtype=np.int64).reshape((-1, len(KINDS)))
+    arrays["loss_kinds"] = np.array(KINDS)
+    return arrays
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog="python -m phoray.run",
+        description="Trace an optical system defined by a JSON spec.")
+    parser.add_argument("spec", help="JSON file, as posted to /system")
+    parser.add_argument("--rays", type=float, default=1e5,
+                        help="rays per source (default %(default)g)")
+    parser.add_argument("--workers", type=int, default=cpu_count(),
+                        help="processes to trace on (default %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="rays per chunk (default %(default)s)")
+    parser.add_argument("--system", type=int, default=0,
+                        help="which system in the spec (default %(default)s)")
+    parser.add_argument("--plugins", metavar="DIR",
+                        help="directory with plugin modules")
+    parser.add_argument("--out", default="result.npz",
+                        help="output file (default %(default)s)")
+    parser.add_argument("--sink", metavar="DIR",
+                        help="write the hits to memory mapped files in DIR "
+                        "instead of --out")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="save the progress to FILE now and then")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the --checkpoint, if any")
+    args = parser.parse_args(argv)
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+
+    if args.plugins:
+        load_plugins(args.plugins)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    spec = spec["systems"][args.system] if "systems" in spec else spec
+    system = create_system(spec)
+
+    n = int(args.rays)
+    sink = None
+    if args.sink:
+        if args.resume and os.path.exists(os.path.join(args.sink, MANIFEST)):
+            sink = TraceSink.open(args.sink, "r+")
+        else:
+            sink = TraceSink.create(args.sink, system, n)
+    start = time()
+    system.trace(n, workers=args.workers, chunk_size=args.chunk_size,
+                 sink=sink, checkpoint=args.checkpoint, resume=args.resume)
+    seconds = time() - start
+    rays = n * len(system.sources)
+    print "Traced %d rays in %.1f s (%.3g rays/s)" % (
+        rays, seconds, rays / seconds if seconds else 0)
+    for i, (element, losses) in enumerate(zip(system.elements,
+                                              system.losses())):
+        line = "  element %d (%s): " % (i, type(element).__name__)
+        if sink is None:  # otherwise the hits are not in memory
+            line += "%d hits, " % len(element.footprint)
+        print line + "%d lost" % sum(losses.values())
+
+    if sink is not None:
+        print "Saved", args.sink
+    else:
+        np.savez(args.out, **footprint_arrays(system))
+        print "Saved", args.out
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Trace output kept on disk instead of in memory, for traces too large
+for the footprints to fit in RAM.
+
+A TraceSink is a directory with one .npy file per element, opened as
+memory maps, and a manifest.json describing the run. Each file holds
+one record (see RECORD) per traced ray, in source order like
+TraceFootprints, so chunks can be written in any order and by several
+processes at once. Positions and directions are in the element's local
+coordinates; the direction is the one the ray leaves the element with
+(NaN after a Detector). Rays that did not reach the element have hit
+False.
+
+    sink = TraceSink.create("run1", system, n)
+    system.trace(n, workers=16, sink=sink)
+    ...
+    sink = TraceSink.open("run1")      # later; nothing is loaded yet
+    for hits in sink.hits(0):          # the hits on element 0, by chunk
+        ...
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+RECORD = np.dtype([("x", "<f8"), ("y", "<f8"), ("z", "<f8"),
+                   ("dx", "<f8"), ("dy", "<f8"), ("dz", "<f8"),
+                   ("wavelength", "<f8"), ("source", "<i4"), ("hit", "?")])
+
+MANIFEST = "manifest.json"
+
+
+class TraceSink(object):
+
+    """Per ray, per element records of a trace, in memory mapped .npy
+    files. Use create() or open() rather than the constructor. The
+    files are only opened when first needed, and a sink sent to
+    another process opens them again there."""
+
+    def __init__(self, directory, manifest, mode="r"):
+        self.directory = directory
+        self.manifest = manifest
+        self.mode = mode
+        self._records = {}
+
+    @classmethod
+    def create(cls, directory, system, n):
+        """Make a sink for tracing n rays from each source of the
+        system. The files are allocated at their full size, but on
+        most file systems take no space until written."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        n_rays = n * len(system.sources)
+        elements = []
+        for i, element in enumerate(system.elements):
+            filename = "element%d.npy" % i
+            np.lib.format.open_memmap(os.path.join(directory, filename),
+                                      mode="w+", dtype=RECORD,
+                                      shape=(n_rays,))
+            elements.append(dict(type=type(element).__name__,
+                                 id=getattr(element, "id", None),
+                                 file=filename))
+        manifest = dict(rays=n_rays, rays_per_source=n,
+                        sources=len(system.sources), elements=elements,
+                        fields=RECORD.names, complete=False, losses=None)
+        sink = cls(directory, manifest, "r+")
+        sink._write_manifest()
+        return sink
+
+    @classmethod
+    def open(cls, directory, mode="r"):
+        """Open the sink of an earlier trace."""
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return cls(directory, json.load(f), mode)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_records"] = {}
+        return state
+
+    def _write_manifest(self):
+        with open(os.path.join(self.directory, MANIFEST), "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True,
+                      separators=(",", ": "))
+
+    def __len__(self):
+        return len(self.manifest["elements"])
+
+    def records(self, i):
+        """The (memory mapped) array of records for element i."""
+        records = self._records.get(i)
+        if records is None:
+            filename = self.manifest["elements"][i]["file"]
+            records = self._records[i] = np.load(
+                os.path.join(self.directory, filename), mmap_mode=self.mode)
+        return records
+
+    def store(self, start, result, elements):
+        """Write a TraceResult of the given elements into the records
+        from start onwards."""
+        first = result.rays[0]
+        end = start + len(first)
+        for i, (element, rays) in enumerate(zip(elements, result.rays[1:])):
+            local = element.localize_many(rays)
+            records = self.records(i)[start:end]
+            records["x"], records["y"], records["z"] = local.endpoints.T
+            records["dx"], records["dy"], records["dz"] = local.directions.T
+            records["wavelength"] = first.wavelengths
+            records["source"] = first.source
+            records["hit"] = rays.alive
+
+    def hits(self, i, source=None, chunk_size=1000000):
+        """Generate the records of the rays that hit element i
+        (optionally only those from the given source), reading
+        chunk_size records at a time."""
+        records = self.records(i)
+        for start in xrange(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            mask = chunk["hit"]
+            if source is not None:
+                mask = mask & (chunk["source"] == source)
+            yield np.array(chunk[mask])
+
+    def element(self, i, source=None):
+        """The x, y and wavelength arrays of the hits on element i, as
+        for TraceFootprints. This reads them all into memory."""
+        hits = np.concatenate(list(self.hits(i, source)) or
+                              [np.empty(0, RECORD)])
+        return hits["x"], hits["y"], hits["wavelength"]
+
+    def state(self, slots):
+        """Write the records to disk. They are the state of a trace into
+        the sink, so a checkpoint needs nothing more (see
+        OpticalSystem.trace)."""
+        for i in xrange(len(self)):
+            self.records(i).flush()
+        return {}
+
+    def restore(self, slots, state):
+        """Nothing to do, as the records are already on disk."""
+
+    def finish(self, losses=None):
+        """Write everything to disk, and mark the run as complete in
+        the manifest, with the loss counts of each element."""
+        for records in self._records.values():
+            records.flush()
+        self.manifest["complete"] = True
+        self.manifest["losses"] = losses
+        self._write_manifest()
@@ -1,5 +1,7 @@
 from math import *
 
+import numpy as np
+
 
 def quadratic(a, b, c, no_complex=True):
     """
@@ -22,3 +24,25 @@ def quadratic(a, b, c, no_complex=True):
             x1 = complex(0, -b + sqrt(-delta)) / (2 * a)
             x2 = complex(0, -b - sqrt(-delta)) / (2 * a)
     return x1, x2
+
+
+def quadratic_many(a, b, c):
+    """
+    Solve a*x**2 + b*x + c = 0 elementwise for arrays of coefficients.
+    Returns the two roots and a mask of the equations that have real
+    solutions (the roots are NaN or meaningless elsewhere). Degenerate
+    cases are treated like in quadratic().
+    """
+    a, b, c = np.broadcast_arrays(a, b, c)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = b ** 2 - 4 * a * c
+        root = np.sqrt(delta)
+        x1 = (-b + root) / (2 * a)
+        x2 = (-b - root) / (2 * a)
+        linear = a == 0.
+        if linear.any():
+            x = -c / b
+            x1 = np.where(linear, x, x1)
+            x2 = np.where(linear, x, x2)
+        ok = np.where(linear, b != 0., delta >= 0)
+    return x1, x2, ok
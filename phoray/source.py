@@ -1,8 +1,10 @@
-from random import seed, randint, gauss
+from random import randint
 from collections import OrderedDict
 
+import numpy as np
+
 from member import Member
-from ray import Ray
+from ray import Ray, RayBundle, rotation_matrices
 from minivec import Vec, Mat
 
 
@@ -15,6 +17,9 @@ base_schema = OrderedDict([("wavelength", {"type": "length"}),
 
 class Source(Member):
 
+    # Sources that use random numbers should set their own seed
+    random_seed = 0
+
     def __init__(self,
                  wavelength=0.0,
                  color="#ffffff",
@@ -33,6 +38,25 @@ class Source(Member):
         Should return a list of Rays, probably limited by n.
         """
 
+    def generate_many(self, n, chunk=0):
+        """Generate n rays as a RayBundle (in global coordinates).
+        Random sources should draw chunk number chunk of their rays,
+        using random_state(chunk), so that any chunk can be
+        generated on its own. This generic version just collects the
+        rays from generate(); child classes may override it.
+        """
+        return RayBundle.from_rays(self.generate(n))
+
+    def random_state(self, chunk=0):
+        """
+        The random number generator for the given chunk of this
+        source's rays. Each chunk gets an independent stream derived
+        from (random_seed, chunk), so that a large job can be split
+        into chunks, traced in any order or on different machines,
+        and still give the same rays.
+        """
+        return np.random.RandomState([self.random_seed, chunk])
+
 
 class TrivialSource(Source):
 
@@ -45,6 +69,11 @@ class TrivialSource(Source):
             yield self.globalize(Ray(direction=self.axis,
                                      wavelength=self.wavelength))
 
+    def generate_many(self, n=1, chunk=0):
+        return RayBundle(self.globalize_vectors(np.zeros((n, 3))),
+                         self.globalize_directions([tuple(self.axis)]),
+                         self.wavelength)
+
 
 class GaussianSource(Source):
 
@@ -58,24 +87,45 @@ class GaussianSource(Source):
 
     def __init__(self, size=Vec(0, 0, 0),
                  divergence=Vec(0, 0, 0),
-                 random_seed=randint(0, 1000000),
+                 random_seed=-1,
                  *args, **kwargs):
+        """A negative random_seed means that a new one is picked."""
         self.size = Vec(size)
         self.divergence = Vec(divergence)
+        if random_seed < 0:
+            random_seed = randint(0, 1000000)
         self.random_seed = random_seed
-        seed(random_seed)
 
         Source.__init__(self, *args, **kwargs)
 
-    def generate(self, n=1):
+        # The stream used by generate()
+        self._random_state = self.random_state()
 
+    def generate(self, n=1):
+        return self._generate(n, self._random_state)
+
+    def generate_many(self, n=1, chunk=0):
+        # Same draws, in the same order, as _generate
+        normals = self.random_state(chunk).standard_normal((n, 6))
+        local_positions = normals[:, :3] * tuple(self.size)
+        local_rotations = normals[:, 3:] * (self.divergence.y,
+                                            self.divergence.x,
+                                            self.divergence.z)
+        directions = np.einsum("j,njk->nk", tuple(self.axis),
+                               rotation_matrices(local_rotations))
+        return RayBundle(self.globalize_vectors(local_positions),
+                         self.globalize_directions(directions),
+                         self.wavelength)
+
+    def _generate(self, n, random_state):
+        gauss = random_state.standard_normal
         for i in xrange(n):
-            local_position = Vec(gauss(0, self.size.x),
-                                 gauss(0, self.size.y),
-                                 gauss(0, self.size.z))
-            local_rotation = Vec(gauss(0, self.divergence.y),
-                                 gauss(0, self.divergence.x),
-                                 gauss(0, self.divergence.z))
+            local_position = Vec(gauss() * self.size.x,
+                                 gauss() * self.size.y,
+                                 gauss() * self.size.z)
+            local_rotation = Vec(gauss() * self.divergence.y,
+                                 gauss() * self.divergence.x,
+                                 gauss() * self.divergence.z)
             rotation = Mat().rotate(local_rotation)
 
             yield self.globalize(
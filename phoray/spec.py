@@ -0,0 +1,96 @@
+"""
+Building optical systems from specs, the JSON descriptions of systems
+that the UI sends to the server (see /system in server.py):
+
+    {"type": "Free", "id": 0, "args": {},
+     "elements": [{"type": "Mirror", "id": 1,
+                   "args": {"position": {"x": 0, "y": 0, "z": 1}, ...,
+                            "geometry": {"type": "Plane", "id": 2,
+                                         "args": {...}}}}, ...],
+     "sources": [{"type": "GaussianSource", "id": 3, "args": {...}}]}
+
+The types are looked up by class name among the classes of the phoray
+modules, and of any plugins loaded with load_plugins().
+"""
+
+from collections import OrderedDict
+from imp import find_module, load_module
+from inspect import getmembers, isclass, getmro
+from operator import itemgetter
+import os
+
+import system
+import element
+import surface
+import source
+
+
+def _subclasses(classes, base):
+    """The classes that inherit base, by name."""
+    return OrderedDict((name, cls) for name, cls in classes
+                       if base in getmro(cls)[1:])
+
+
+def _module_classes(module):
+    return sorted(getmembers(module, isclass), key=itemgetter(0))
+
+
+# List all the things we have available, by checking which classes
+# inherit the different base classes.
+
+system_classes = _subclasses(_module_classes(system), system.OpticalSystem)
+element_classes = _subclasses(_module_classes(element), element.Element)
+surface_classes = _subclasses(_module_classes(surface), surface.Surface)
+source_classes = _subclasses(_module_classes(source), source.Source)
+
+
+def load_plugins(directory):
+    """Load the modules in the given directory and add the classes
+    they define to the available ones."""
+    plugins = [os.path.splitext(mod)[0]
+               for mod in os.listdir(directory) if mod.endswith(".py")]
+    classes = [(name, cls)
+               for plugin in sorted(plugins)
+               for name, cls in _module_classes(
+                   load_module(plugin, *find_module(plugin, [directory])))]
+    system_classes.update(_subclasses(classes, system.OpticalSystem))
+    element_classes.update(_subclasses(classes, element.Element))
+    surface_classes.update(_subclasses(classes, surface.Surface))
+    source_classes.update(_subclasses(classes, source.Source))
+
+
+def create_geometry(spec):
+    cls = surface_classes.get(spec["type"])
+    args = dict((name, prop) for name, prop in spec["args"].items())
+    geometry = cls(**args)
+    geometry.id = spec["id"]
+    return geometry
+
+
+def create_element(spec):
+    cls = element_classes[spec["type"]]
+    args = dict((name, prop) for name, prop in spec["args"].items())
+    args["geometry"] = create_geometry(args["geometry"])
+    element = cls(**args)
+    element.id = spec["id"]
+    return element
+
+
+def create_source(spec):
+    cls = source_classes.get(spec["type"])
+    args = dict((name, prop) for name, prop in spec["args"].items())
+    source = cls(**args)
+    source.id = spec["id"]
+    return source
+
+
+def create_system(spec):
+    """Create a system, with its elements and sources."""
+    system = system_classes[spec["type"]]()
+    system.id = spec["id"]
+    system.elements.extend(create_element(ele_spec)
+                           for ele_spec in spec["elements"])
+    system.sources.extend(create_source(src_spec)
+                          for src_spec in spec["sources"])
+    system.update()
+    return system
@@ -0,0 +1,79 @@
+"""Timing and ray counts of a trace, per element and per source."""
+
+from time import time
+
+
+class TraceStats(object):
+
+    """
+    Where the time of a trace goes. For each element, the time spent
+    propagating rays through it and the number of rays coming in,
+    going out and lost there. For each source, the number of rays
+    traced, and the time spent generating and propagating them.
+
+    In a batch trace the rays of all sources go through the elements
+    together, so the propagation time is shared between the sources
+    by their number of rays. The times from a parallel trace are added
+    up over the worker processes.
+    """
+
+    def __init__(self, n_elements, n_sources):
+        self.elements = [dict(time=0.0, rays_in=0, rays_out=0)
+                         for i in xrange(n_elements)]
+        self.sources = [dict(time=0.0, rays=0) for i in xrange(n_sources)]
+
+    def add_element(self, i, seconds, rays_in, rays_out):
+        stats = self.elements[i]
+        stats["time"] += seconds
+        stats["rays_in"] += rays_in
+        stats["rays_out"] += rays_out
+
+    def add_source(self, i, seconds, rays=0):
+        stats = self.sources[i]
+        stats["time"] += seconds
+        stats["rays"] += rays
+
+    def share_time(self, seconds, counts):
+        """Share the time among the sources, by the number of rays
+        each had in the trace (a sequence, one count per source)."""
+        total = sum(counts)
+        for i, count in enumerate(counts):
+            if count:
+                self.sources[i]["time"] += seconds * count / total
+
+    def generated(self, i, rays):
+        """Pass on the rays from source i, counting them and the time
+        taken to generate them."""
+        rays = iter(rays)
+        while True:
+            start = time()
+            try:
+                ray = next(rays)
+            except StopIteration:
+                return
+            self.add_source(i, time() - start, 1)
+            yield ray
+
+    def merge(self, other):
+        for mine, theirs in zip(self.elements + self.sources,
+                                other.elements + other.sources):
+            for key, value in theirs.items():
+                mine[key] += value
+
+    def to_dict(self):
+        """The stats as a dict of plain numbers, including rays lost
+        and rays per second."""
+        elements = []
+        for stats in self.elements:
+            stats = dict(stats, rays_lost=stats["rays_in"] - stats["rays_out"])
+            stats["rays_per_second"] = _rate(stats["rays_in"], stats["time"])
+            elements.append(stats)
+        sources = [dict(stats, rays_per_second=_rate(stats["rays"],
+                                                     stats["time"]))
+                   for stats in self.sources]
+        return dict(elements=elements, sources=sources,
+                    time=sum(stats["time"] for stats in self.sources))
+
+
+def _rate(rays, seconds):
+    return rays / seconds if seconds > 0 else None
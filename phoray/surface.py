@@ -1,9 +1,12 @@
 from __future__ import division
 from math import *
 
+import numpy as np
+
 from minivec import Vec, Mat
-from ray import Ray
-from solver import quadratic
+from ray import Ray, RayBundle
+from losses import count_losses
+from solver import quadratic, quadratic_many
 from . import Length
 
 
@@ -16,18 +19,87 @@ class Surface(object):
     def __init__(self, xsize=Length(1.0), ysize=Length(1.0)):
         self.xsize, self.ysize = xsize, ysize
 
-    def intersect(self, r):
+    def intersect(self, r, losses=None):
         """This method needs to be implemented by an actual surface.
         Shall return the point where Ray r intersects the surface.
+        If it does not, the cause is counted in losses (a Losses
+        object), if given.
         """
         pass
 
+    def intersect_many(self, origins, directions, losses=None):
+        """
+        Intersect many rays at once, given as (N, 3) arrays of origins
+        and directions. Returns an (N, 3) array of intersection points
+        and a boolean mask of the rays that hit the surface (the points
+        of the others are NaN). The rays that miss are counted in
+        losses, if given.
+
+        This generic version loops over intersect(); actual surfaces
+        should override it with an array implementation.
+        """
+        points = np.full(np.shape(origins), np.nan)
+        hit = np.zeros(len(points), dtype=bool)
+        for i, (o, d) in enumerate(zip(np.asarray(origins).tolist(),
+                                       np.asarray(directions).tolist())):
+            p = self.intersect(Ray(Vec(o), Vec(d)), losses)
+            if p is not None:
+                points[i] = tuple(p)
+                hit[i] = True
+        return points, hit
+
+    def _inside(self, points):
+        """Mask of the points that are within the xsize/ysize aperture."""
+        if self.xsize is None and self.ysize is None:
+            return np.ones(len(points), dtype=bool)
+        x, y = points[:, 0], points[:, 1]
+        with np.errstate(invalid="ignore"):
+            return ((-self.xsize / 2 <= x) & (x <= self.xsize / 2) &
+                    (-self.ysize / 2 <= y) & (y <= self.ysize / 2))
+
+    def _closest(self, a, r, t1, t2, hit, upper, shift, losses=None):
+        """
+        Pick the intersection on the right half of a centered quadric
+        (the z > 0 half if upper is True), clip it to the aperture and
+        move it back down by shift along z. a and r are the shifted ray
+        origins and the directions, t1 and t2 the roots.
+        """
+        with np.errstate(invalid="ignore"):
+            tmax, tmin = np.maximum(t1, t2), np.minimum(t1, t2)
+            if upper:
+                t = np.where(a[:, 2] + tmax * r[:, 2] > 0, tmax, tmin)
+            else:
+                t = np.where(a[:, 2] + tmin * r[:, 2] < 0, tmin, tmax)
+        points = a + t[:, np.newaxis] * r
+        hit = self._clip(points, hit, losses)
+        points[:, 2] -= shift
+        points[~hit] = np.nan
+        return points, hit
+
+    def _clip(self, points, hit, losses=None):
+        """Drop the hits outside the aperture, counting them in losses."""
+        inside = self._inside(points)
+        if losses is not None:
+            losses.add("outside", hit & ~inside)
+        return hit & inside
+
     def normal(self, p):
         """This method needs to be implemented by an actual surface.
         Shall return the normal to the surface at point p.
         """
         pass
 
+    def normal_many(self, points):
+        """
+        Normals at an (N, 3) array of points. This generic version
+        loops over normal(); actual surfaces should override it.
+        """
+        normals = np.full(np.shape(points), np.nan)
+        for i, p in enumerate(np.asarray(points).tolist()):
+            if p[0] == p[0]:  # skip NaN points
+                normals[i] = tuple(self.normal(Vec(p)))
+        return normals
+
     def grating_direction(self, p):
         """
         Returns a vector oriented along the grating lines (if any).
@@ -44,26 +116,56 @@ class Surface(object):
         rotation = Mat().rotateAxis(90, a)
         return normal.transformDir(rotation).normalize()
 
-    def reflect(self, ray):
+    def grating_direction_many(self, points):
+        """
+        Array version of grating_direction. The direction is simply
+        the local x-axis projected onto the tangent plane.
+        """
+        n = self.normal_many(points)
+        g = -n[:, :1] * n
+        g[:, 0] += 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return g / np.sqrt((g ** 2).sum(axis=1))[:, np.newaxis]
+
+    def reflect(self, ray, losses=None):
 
         """
         Reflect the given ray in the surface, returning the reflected ray.
         """
 
         r = ray.direction
-        P = self.intersect(ray)
+        P = self.intersect(ray, losses)
         if P is None:
             return None
         else:
-            return Ray(P, r.reflect(self.normal(P)))
+            return Ray(P, r.reflect(self.normal(P)), ray.wavelength)
+
+    def reflect_many(self, rays, losses=None):
+        """
+        Reflect a RayBundle (in local coordinates) in the surface,
+        returning the reflected bundle. Rays that miss are killed.
+        """
+        P, hit = self.intersect_many(rays.endpoints, rays.directions, losses)
+        n = self.normal_many(P)
+        r = rays.directions
+        reflected = r - 2 * (r * n).sum(axis=1)[:, np.newaxis] * n
+        return RayBundle(P, reflected, rays.wavelengths, rays.alive & hit,
+                         rays.source)
 
-    def diffract(self, ray, d, order, line_spacing_function=None):
+    def diffract(self, ray, d, order, line_spacing_function=None,
+                 losses=None):
 
         """
         Diffract the given ray in the surface, returning the diffracted ray.
+
+        Uses the grating equation in vector form: the component of the
+        reflected direction across the grating lines (along t = g x n)
+        is shifted by order * wavelength / d, the component along the
+        lines is kept and the normal component follows from the
+        direction being a unit vector.
         """
 
-        P = self.intersect(ray)
+        P = self.intersect(ray, losses)
         if P is None:
             return None
         else:
@@ -79,48 +181,101 @@ class Surface(object):
             n = self.normal(P)
             r_ref = refl.direction
             g = self.grating_direction(P)
-            # TODO: seems like there should be a simpler way to do
-            # this. But remember that the direction of the grating
-            # must be taken into account!
-            phi = acos(r_ref.dot(g))
-            theta = acos(r_ref.dot(n) / sin(phi))
-            print "phi", phi, "theta", theta
-            try:
-                theta_m = asin(-order * ray.wavelength /
-                                (d * sin(phi)) - sin(theta))
-            except Exception as e:
-                print "Discarding ray:", str(e)
+            t = g.cross(n)
+            r_g = r_ref.dot(g)
+            r_t = r_ref.dot(t) + order * ray.wavelength / d
+            r_n2 = 1 - r_g ** 2 - r_t ** 2
+            if r_n2 < 0:
+                count_losses(losses, "evanescent")
                 return None
-            rotation = Mat.RotateAxis(-degrees(theta + theta_m), g)
-            r_diff = r_ref.transformDir(rotation)
+            r_diff = g * r_g + t * r_t + n * copysign(sqrt(r_n2),
+                                                      r_ref.dot(n))
             return Ray(P, r_diff, ray.wavelength)
 
-    def refract(self, ray, i1, i2):
+    def diffract_many(self, rays, d, order, line_spacing_function=None,
+                      losses=None):
+        """
+        Diffract a RayBundle (in local coordinates) in the surface, like
+        diffract() but for all rays at once. Rays whose order is
+        evanescent are killed.
+        """
+        reflected = self.reflect_many(rays, losses)
+        if order == 0 or d == 0:
+            return reflected
+        P = reflected.endpoints
+        if d is None:
+            if line_spacing_function is None:
+                return reflected
+            # VLS grating
+            d = np.ones(len(P))
+            for i in np.flatnonzero(reflected.alive):
+                d[i] = line_spacing_function(Vec(P[i].tolist()))
+        r = reflected.directions
+        n = self.normal_many(P)
+        g = self.grating_direction_many(P)
+        t = np.cross(g, n)
+        with np.errstate(invalid="ignore"):
+            r_g = (r * g).sum(axis=1)
+            r_t = (r * t).sum(axis=1) + order * rays.wavelengths / d
+            r_n2 = 1 - r_g ** 2 - r_t ** 2
+            propagating = r_n2 >= 0
+            r_n = np.copysign(np.sqrt(np.where(propagating, r_n2, 0)),
+                              (r * n).sum(axis=1))
+        diffracted = (r_g[:, np.newaxis] * g + r_t[:, np.newaxis] * t +
+                      r_n[:, np.newaxis] * n)
+        if losses is not None:
+            losses.add("evanescent", reflected.alive & ~propagating)
+        return RayBundle(P, diffracted, rays.wavelengths,
+                         reflected.alive & propagating, rays.source)
+
+    def refract(self, ray, i1, i2, losses=None):
         """
         Refurns the refracted ray given an incident ray.
-        Uses Snell's law.
-
-        FIXME: I don't think this is quite right.
+        Uses Snell's law in vector form; i1 is the refraction index on
+        the incoming side and i2 on the other. Returns None in case of
+        total internal reflection.
         """
-        P = self.intersect(ray)
-        print P
+        P = self.intersect(ray, losses)
         if P is not None:
             r = ray.direction
             n = self.normal(P)
             dot = n.dot(r)
             if dot >= 0:
                 n = -n
-            theta_in = acos(n.dot(r))
-            if sin(theta_in) == 0:
-                return ray
-            print i1, i2, sin(theta_in)
-            theta_out = asin((i1 / i2) * sin(theta_in))
-            v = r % n
-            r2 = (-n).transformDir(Mat.RotateAxis(degrees(theta_out), v))
+                dot = -dot
+            eta = i1 / i2
+            k = 1 - eta ** 2 * (1 - dot ** 2)
+            if k < 0:
+                count_losses(losses, "tir")
+                return None
+            r2 = r * eta - n * (eta * dot + sqrt(k))
             return Ray(P, r2, ray.wavelength)
         else:
             return None
 
+    def refract_many(self, rays, i1, i2, losses=None):
+        """
+        Refract a RayBundle (in local coordinates), like refract() but
+        for all rays at once. Totally internally reflected rays are
+        killed.
+        """
+        P, hit = self.intersect_many(rays.endpoints, rays.directions, losses)
+        r = rays.directions
+        n = self.normal_many(P)
+        eta = i1 / i2
+        with np.errstate(invalid="ignore"):
+            dot = (n * r).sum(axis=1)
+            n = np.where((dot >= 0)[:, np.newaxis], -n, n)
+            dot = -np.abs(dot)
+            k = 1 - eta ** 2 * (1 - dot ** 2)
+            transmitted = k >= 0
+            root = np.sqrt(np.where(transmitted, k, 0))
+        refracted = eta * r - (eta * dot + root)[:, np.newaxis] * n
+        if losses is not None:
+            losses.add("tir", rays.alive & hit & ~transmitted)
+        return RayBundle(P, refracted, rays.wavelengths,
+                         rays.alive & hit & transmitted, rays.source)
+
     def mesh(self, res):
         """
         This method needs to be implemented by an actual surface.
@@ -128,6 +283,26 @@ class Surface(object):
         """
         pass
 
+    def _grid(self, res):
+        """The x and y coordinates of a (res + 1) x (res + 1) grid
+        covering the surface, as flat arrays with y varying fastest."""
+        d = np.arange(res + 1)
+        x = -self.xsize / 2 + d * self.xsize / res
+        y = -self.ysize / 2 + d * self.ysize / res
+        return np.repeat(x, res + 1), np.tile(y, res + 1)
+
+    def _grid_mesh(self, x, y, z, res):
+        """The vertices and faces of a mesh on a grid from _grid."""
+        verts = np.column_stack((x, y, z))
+        current = (np.arange(res)[:, np.newaxis] * (res + 1) +
+                   np.arange(res)).ravel()
+        faces = np.empty((2 * res * res, 3), dtype=int)
+        faces[0::2] = np.column_stack((current, current + 1,
+                                       current + 2 + res))
+        faces[1::2] = np.column_stack((current, current + 2 + res,
+                                       current + 1 + res))
+        return verts.tolist(), faces.tolist()
+
 
 class Plane(Surface):
     """
@@ -137,23 +312,29 @@ class Plane(Surface):
     def normal(self, p):
         return Vec(0, 0, 1)
 
-    def intersect(self, ray):
+    def normal_many(self, points):
+        normals = np.zeros(np.shape(points))
+        normals[:, 2] = 1
+        return normals
+
+    def intersect(self, ray, losses=None):
         r = ray.direction
 
         if ray.direction.z < 0:  # backlit
-            #print "backlit"
+            count_losses(losses, "backlit")
             return None
 
         a = ray.endpoint
         b = a + r
 
         if b.z == a.z:  # parallel case
-            print "parallel"
+            count_losses(losses, "missed")
             return None
         else:
             t = -a.z / (b.z - a.z)
             if t < 0:
                 # Backtracking the ray -> no intersection
+                count_losses(losses, "missed")
                 return None
             p = a + t * r
             if (self.xsize is None and self.ysize is None) or \
@@ -161,25 +342,27 @@ class Plane(Surface):
                      -self.ysize / 2 <= p.y <= self.ysize / 2):
                 return p
             else:
-                print "outside"
+                count_losses(losses, "outside")
                 return None
 
+    def intersect_many(self, origins, directions, losses=None):
+        dz = directions[:, 2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = -origins[:, 2] / dz
+            # backlit, parallel and backtracking rays miss
+            front = dz >= 0
+            hit = front & (dz != 0) & (t >= 0)
+            points = origins + t[:, np.newaxis] * directions
+        if losses is not None:
+            losses.add("backlit", ~front)
+            losses.add("missed", front & ~hit)
+        hit = self._clip(points, hit, losses)
+        points[~hit] = np.nan
+        return points, hit
+
     def mesh(self, res=10):
-        verts = []
-        faces = []
-        w = self.xsize
-        h = self.ysize
-        for i, x in enumerate(-w / 2 + d * w / res
-                               for d in xrange(res + 1)):
-            for j, y in enumerate(-h / 2 + d * h / res
-                                   for d in xrange(res + 1)):
-                verts.append((x, y, 0))
-        for i in xrange(res):
-            for j in xrange(res):
-                current = i * (res + 1) + j
-                faces.append((current, current + 1, current + 2 + res))
-                faces.append((current, current + 2 + res, current + 1 + res))
-        return verts, faces
+        x, y = self._grid(res)
+        return self._grid_mesh(x, y, np.zeros_like(x), res)
 
 
 class Sphere(Surface):
@@ -197,7 +380,10 @@ class Sphere(Surface):
     def normal(self, p):
         return Vec(p.x, p.y, p.z + self.R) / self.R
 
-    def intersect(self, ray):
+    def normal_many(self, points):
+        return (points + (0, 0, self.R)) / self.R
+
+    def intersect(self, ray, losses=None):
 
         r = ray.direction
         #if r.z * self.R <= 0:  # backlit
@@ -212,7 +398,7 @@ class Sphere(Surface):
 
         if t is None or t < 0:  # no
             # intersection
-            print "missed"
+            count_losses(losses, "missed")
             return None
         else:
             # Figure out which intersection we should use
@@ -232,26 +418,23 @@ class Sphere(Surface):
                 return Vec(p.x, p.y, p.z - self.R)
                 #return Vec(p.x, p.y, p.z)
             else:
-                print "outside"
+                count_losses(losses, "outside")
                 return None
 
+    def intersect_many(self, origins, directions, losses=None):
+        R = self.R
+        r = directions
+        a = origins + (0, 0, R)
+        t1, t2, hit = quadratic_many((r ** 2).sum(axis=1),
+                                     2 * (a * r).sum(axis=1),
+                                     (a ** 2).sum(axis=1) - R ** 2)
+        count_losses(losses, "missed", ~hit)
+        return self._closest(a, r, t1, t2, hit, R > 0, R, losses)
+
     def mesh(self, res=10):
-        verts = []
-        faces = []
-        w = self.xsize
-        h = self.ysize
-        sgn = copysign(1, self.R)
-
-        for x in (-w / 2 + d * w / res for d in xrange(res + 1)):
-            for y in (-h / 2 + d * h / res for d in xrange(res + 1)):
-                z = sgn * sqrt(self.R ** 2 - x ** 2 - y ** 2)
-                verts.append((x, y, z - self.R))
-        for i in xrange(res):
-            for j in xrange(res):
-                current = i * (res + 1) + j
-                faces.append((current, current + 1, current + 2 + res))
-                faces.append((current, current + 2 + res, current + 1 + res))
-        return verts, faces
+        x, y = self._grid(res)
+        z = copysign(1, self.R) * np.sqrt(self.R ** 2 - x ** 2 - y ** 2)
+        return self._grid_mesh(x, y, z - self.R, res)
 
 
 class Cylinder(Surface):
@@ -264,10 +447,16 @@ class Cylinder(Surface):
     def normal(self, p):
         return (Vec(0, -p.y, -p.z - self.R)) / self.R
 
-    def intersect(self, ray):
+    def normal_many(self, points):
+        normals = -(points + (0, 0, self.R)) / self.R
+        normals[:, 0] = 0
+        return normals
+
+    def intersect(self, ray, losses=None):
         r = ray.direction
 
         if r.z * self.R <= 0:  # backlit
+            count_losses(losses, "backlit")
             return None
 
         a = ray.endpoint + Vec(0, 0, self.R)
@@ -278,6 +467,7 @@ class Cylinder(Surface):
                       a.z ** 2 + a.y ** 2 - self.R ** 2)
 
         if t is None or t < 0:  # no intersection
+            count_losses(losses, "missed")
             return None
         else:
             if self.R > 0:
@@ -295,25 +485,29 @@ class Cylinder(Surface):
                     -self.ysize / 2 <= p.y <= self.ysize / 2):
                 return Vec(p.x, p.y, p.z - self.R)
             else:
+                count_losses(losses, "outside")
                 return None
 
+    def intersect_many(self, origins, directions, losses=None):
+        R = self.R
+        r = directions
+        a = origins + (0, 0, R)
+        t1, t2, hit = quadratic_many(r[:, 2] ** 2 + r[:, 1] ** 2,
+                                     2 * a[:, 2] * r[:, 2] +
+                                     2 * a[:, 1] * r[:, 1],
+                                     a[:, 2] ** 2 + a[:, 1] ** 2 - R ** 2)
+        with np.errstate(invalid="ignore"):
+            front = r[:, 2] * R > 0
+        if losses is not None:
+            losses.add("backlit", ~front)
+            losses.add("missed", front & ~hit)
+        hit &= front
+        return self._closest(a, r, t1, t2, hit, R > 0, R, losses)
+
     def mesh(self, res=10):
-        verts = []
-        faces = []
-        w = self.xsize
-        h = self.ysize
-        sgn = copysign(1, self.R)
-        for x in (-w / 2 + d * w / res for d in xrange(res + 1)):
-            for y in (-h / 2 + d * h / res for d in xrange(res + 1)):
-                z = sgn * sqrt(self.R ** 2 - y ** 2)
-                verts.append((x, y, z - self.R))
-
-        for i in xrange(res):
-            for j in xrange(res):
-                current = i * (res + 1) + j
-                faces.append((current, current + 1, current + 2 + res))
-                faces.append((current, current + 2 + res, current + 1 + res))
-        return verts, faces
+        x, y = self._grid(res)
+        z = copysign(1, self.R) * np.sqrt(self.R ** 2 - y ** 2)
+        return self._grid_mesh(x, y, z - self.R, res)
 
 
 class Ellipsoid(Surface):
@@ -335,7 +529,12 @@ class Ellipsoid(Surface):
                 -2 * (p.z + c) / c ** 2)
         return n.normalize()
 
-    def intersect(self, ray):
+    def normal_many(self, points):
+        a, b, c = self.a, self.b, self.c
+        n = -2 * (points + (0, 0, c)) / (a ** 2, b ** 2, c ** 2)
+        return n / np.sqrt((n ** 2).sum(axis=1))[:, np.newaxis]
+
+    def intersect(self, ray, losses=None):
         a, b, c = self.a, self.b, self.c
         r = ray.direction
         p0 = ray.endpoint + Vec(0, 0, c)
@@ -349,6 +548,7 @@ class Ellipsoid(Surface):
                 b ** 2 - c ** 2)
 
         if t is None:  # no intersection
+            count_losses(losses, "missed")
             return None
         else:
             # Figure out which intersection we should use
@@ -367,25 +567,27 @@ class Ellipsoid(Surface):
                     (-self.ysize / 2 <= p.y <= self.ysize / 2)):
                 return Vec(p.x, p.y, p.z - c)
             else:
+                count_losses(losses, "outside")
                 return None
 
+    def intersect_many(self, origins, directions, losses=None):
+        a, b, c = self.a, self.b, self.c
+        r = directions
+        p0 = origins + (0, 0, c)
+        # scale x and y so that the ellipsoid becomes a sphere of radius c
+        k = np.array([c ** 2 / a ** 2, c ** 2 / b ** 2, 1])
+        t1, t2, hit = quadratic_many((k * r ** 2).sum(axis=1),
+                                     2 * (k * p0 * r).sum(axis=1),
+                                     (k * p0 ** 2).sum(axis=1) - c ** 2)
+        count_losses(losses, "missed", ~hit)
+        return self._closest(p0, r, t1, t2, hit, a * b * c > 0, c, losses)
+
     def mesh(self, res=10):
-        verts = []
-        faces = []
-        w, h = self.xsize, self.ysize
         a, b, c = self.a, self.b, self.c
         sgn = copysign(1, self.a * self.b * self.c)
-        for x in (-w / 2 + d * w / res for d in xrange(res + 1)):
-            for y in (-h / 2 + d * h / res for d in xrange(res + 1)):
-                z = sgn * sqrt((c ** 2) * (
-                        1 - x ** 2 / a ** 2 - y ** 2 / b ** 2))
-                verts.append((x, y, z - c))
-        for i in xrange(res):
-            for j in xrange(res):
-                current = i * (res + 1) + j
-                faces.append((current, current + 1, current + 2 + res))
-                faces.append((current, current + 2 + res, current + 1 + res))
-        return verts, faces
+        x, y = self._grid(res)
+        z = sgn * np.sqrt((c ** 2) * (1 - x ** 2 / a ** 2 - y ** 2 / b ** 2))
+        return self._grid_mesh(x, y, z - c, res)
 
 
 class Paraboloid(Surface):
@@ -409,7 +611,13 @@ class Paraboloid(Surface):
         f = sqrt((self.d * p.x) ** 2 + (self.e * p.y) ** 2 + 1)
         return Vec(self.d * p.x / f, self.e * p.y / f, 1 / f)
 
-    def intersect(self, ray):
+    def normal_many(self, points):
+        n = np.ones(np.shape(points))
+        n[:, 0] = self.d * points[:, 0]
+        n[:, 1] = self.e * points[:, 1]
+        return n / np.sqrt((n ** 2).sum(axis=1))[:, np.newaxis]
+
+    def intersect(self, ray, losses=None):
         r = ray.direction
         p = ray.endpoint
         a2, b2, c = self.a ** 2, self.b ** 2, self.c
@@ -418,6 +626,7 @@ class Paraboloid(Surface):
                       2 * p.x * r.x / a2 + 2 * p.y * r.y / b2 - r.z / c,
                       p.x ** 2 / a2 + p.y ** 2 / b2 - p.z / c)
         if t is None or t < 0:  # no intersection
+            count_losses(losses, "missed")
             return None
         else:
             if self.concave:
@@ -429,20 +638,31 @@ class Paraboloid(Surface):
                     and -ysize / 2 <= ip.y <= ysize / 2)):
                 return ip
             else:
+                count_losses(losses, "outside")
                 return None
 
+    def intersect_many(self, origins, directions, losses=None):
+        r = directions
+        p = origins
+        a2, b2, c = self.a ** 2, self.b ** 2, self.c
+        t1, t2, hit = quadratic_many(
+            r[:, 0] ** 2 / a2 + r[:, 1] ** 2 / b2,
+            2 * p[:, 0] * r[:, 0] / a2 + 2 * p[:, 1] * r[:, 1] / b2 -
+            r[:, 2] / c,
+            p[:, 0] ** 2 / a2 + p[:, 1] ** 2 / b2 - p[:, 2] / c)
+        with np.errstate(invalid="ignore"):
+            if self.concave:
+                t = np.maximum(t1, t2)
+            else:
+                t = np.minimum(t1, t2)
+        count_losses(losses, "missed", ~hit)
+        points = p + t[:, np.newaxis] * r
+        hit = self._clip(points, hit, losses)
+        points[~hit] = np.nan
+        return points, hit
+
     def mesh(self, res=10):
-        verts = []
-        faces = []
-        w = self.xsize
-        h = self.ysize
         a, b, c = self.a, self.b, self.c
-        for x in (-w / 2 + d * w / res for d in xrange(res + 1)):
-            for y in (-h / 2 + d * h / res for d in xrange(res + 1)):
-                verts.append((x, y, c * (x ** 2 / a ** 2 + y ** 2 / b ** 2)))
-        for i in xrange(res):
-            for j in xrange(res):
-                current = i * (res + 1) + j
-                faces.append((current, current + 1, current + 2 + res))
-                faces.append((current, current + 2 + res, current + 1 + res))
-        return verts, faces
+        x, y = self._grid(res)
+        z = c * (x ** 2 / a ** 2 + y ** 2 / b ** 2)
+        return self._grid_mesh(x, y, z, res)
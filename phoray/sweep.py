@@ -0,0 +1,176 @@
+"""
+Tracing a system at many wavelengths at once, e.g. to scan the photon
+energy through a monochromator or spectrometer.
+
+Instead of tracing the system again for each wavelength, each chunk of
+rays is generated once per source, so that all wavelengths get the same
+rays. The rays are traced once through the elements before the first
+dispersive one (see Element.dispersive), which treat all wavelengths
+alike, and are then copied for every wavelength of the sweep and traced
+through the rest as one RayBundle.
+"""
+
+from math import sqrt
+from multiprocessing import Pool
+
+import numpy as np
+
+from losses import Losses
+from ray import RayBundle
+
+
+class SweepStats(object):
+
+    """Sums over the hits on one element, per wavelength, from which
+    the statistics of a sweep are calculated. The sums from separate
+    chunks of rays can be merged."""
+
+    def __init__(self, n_wavelengths):
+        self.rays = np.zeros(n_wavelengths, dtype=np.int64)
+        self.hits = np.zeros(n_wavelengths, dtype=np.int64)
+        # x, y, x**2 and y**2 of the hits, in local coordinates
+        self.sums = np.zeros((n_wavelengths, 4))
+
+    def add(self, index, points, hit):
+        """Add rays, where index is the wavelength index of each ray,
+        points where they ended up and hit whether they hit."""
+        n = len(self.rays)
+        self.rays += np.bincount(index, minlength=n)
+        index, points = index[hit], points[hit]
+        self.hits += np.bincount(index, minlength=n)
+        x, y = points[:, 0], points[:, 1]
+        for i, values in enumerate((x, y, x ** 2, y ** 2)):
+            self.sums[:, i] += np.bincount(index, values, minlength=n)
+
+    def merge(self, other):
+        self.rays += other.rays
+        self.hits += other.hits
+        self.sums += other.sums
+
+    def to_dicts(self, wavelengths):
+        """The statistics for each wavelength: the number of rays and
+        hits, the efficiency (hits per ray), and the mean position (x,
+        y) and rms spread (x_rms, y_rms) of the hits."""
+        results = []
+        for wavelength, rays, hits, sums in zip(wavelengths,
+                                                self.rays.tolist(),
+                                                self.hits.tolist(),
+                                                self.sums.tolist()):
+            result = dict(wavelength=wavelength, rays=rays, hits=hits,
+                          efficiency=hits / float(rays) if rays else None,
+                          x=None, y=None, x_rms=None, y_rms=None)
+            if hits:
+                x, y, x2, y2 = [s / hits for s in sums]
+                result.update(x=x, y=y,
+                              x_rms=sqrt(max(x2 - x ** 2, 0)),
+                              y_rms=sqrt(max(y2 - y ** 2, 0)))
+            results.append(result)
+        return results
+
+
+def _tile(rays, wavelengths):
+    """A copy of the RayBundle for each of the wavelengths, in turn."""
+    k = len(wavelengths)
+    return RayBundle(np.tile(rays.endpoints, (k, 1)),
+                     np.tile(rays.directions, (k, 1)),
+                     np.repeat(wavelengths, len(rays)),
+                     np.tile(rays.alive, k), np.tile(rays.source, k))
+
+
+def _sweep_chunk(system, wavelengths, element, task):
+    """Trace one chunk of rays from one source at all the wavelengths.
+    Returns the SweepStats of the chunk and the loss counts."""
+    index, count, chunk = task
+    system.clear_records()
+    rays = system._generate_many(index, count, chunk)
+    k = len(wavelengths)
+    element %= len(system.elements)
+    tiled = False
+    for i, el in enumerate(system.elements):
+        if el.dispersive and not tiled:
+            rays, tiled = _tile(rays, wavelengths), True
+        rays = el.propagate_many(rays, record=False)
+        if not tiled:
+            # the same rays are lost at every wavelength
+            for kind in el.losses:
+                el.losses[kind] *= k
+        if i == element:
+            hits = rays if tiled else _tile(rays, wavelengths)
+    stats = SweepStats(k)
+    stats.add(np.repeat(np.arange(k), count),
+              system.elements[element].localize_vectors(hits.endpoints),
+              hits.alive)
+    return stats, system.losses()
+
+
+# State of a sweep worker process
+_worker = {}
+
+
+def _init_worker(system, wavelengths, element):
+    _worker.update(system=system, wavelengths=wavelengths, element=element)
+
+
+def _sweep_chunk_worker(task):
+    return _sweep_chunk(_worker["system"], _worker["wavelengths"],
+                        _worker["element"], task)
+
+
+def sweep(system, wavelengths, n=1000, element=-1, workers=None,
+          chunk_size=None):
+    """
+    Trace n rays from each source of the system at each of the given
+    wavelengths (the wavelengths of the sources are not used), and
+    return the statistics of the hits on the given element (by
+    default the last one, e.g. a detector) for each wavelength, as a
+    list of dicts (see SweepStats.to_dicts).
+
+    The rays are traced in chunks of chunk_size rays from a source,
+    times the number of wavelengths; by default about 100000 rays in
+    all. Given a number of workers, the chunks are traced on that many
+    processes. As in OpticalSystem.trace, the result does not depend
+    on the number of workers. The loss counts of the whole sweep are
+    left in the elements, while the footprints are cleared.
+
+    Raises ValueError if the system has no element to take the
+    statistics on.
+    """
+    if not system.elements:
+        raise ValueError("The system has no elements")
+    if not -len(system.elements) <= element < len(system.elements):
+        raise ValueError("No element %d in the system" % element)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if chunk_size is None:
+        chunk_size = max(1, 100000 // max(len(wavelengths), 1))
+    tasks = [(i, min(chunk_size, n - start), chunk)
+             for i in xrange(len(system.sources))
+             for chunk, start in enumerate(xrange(0, n, chunk_size))]
+
+    system.clear_records()
+    stats = SweepStats(len(wavelengths))
+    losses = [Losses() for el in system.elements]
+    if workers is None:
+        results = (_sweep_chunk(system, wavelengths, element, task)
+                   for task in tasks)
+        pool = None
+    else:
+        pool = Pool(workers, _init_worker, (system, wavelengths, element))
+        # in order, so that the sums are added up as without workers
+        results = pool.imap(_sweep_chunk_worker, tasks)
+    try:
+        for chunk_stats, chunk_losses in results:
+            stats.merge(chunk_stats)
+            for total, counts in zip(losses, chunk_losses):
+                total.merge(counts)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    system.clear_records()  # the last chunk is in the totals already
+    for el, counts in zip(system.elements, losses):
+        el.losses.merge(counts)
+    return stats.to_dicts(wavelengths.tolist())
@@ -1,9 +1,242 @@
 # Describes an optical system
 from collections import OrderedDict
 from math import *
+import json
+import os
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from time import time
+
+import numpy as np
 
 from minivec import Vec, Mat
-from ray import Ray
+from ray import Ray, RayBundle
+from stats import TraceStats
+
+
+class TraceResult(object):
+
+    """The outcome of tracing a RayBundle through a system.
+
+    rays[0] is the bundle as generated by the sources and rays[i + 1]
+    the bundle after element i. All bundles are in global coordinates
+    and aligned, so that index j is the same ray throughout. A ray that
+    is dead in one bundle stays dead in the following ones.
+    """
+
+    def __init__(self, rays):
+        self.rays = rays
+
+    def hits(self, element, source=None):
+        """The points (an (N, 3) array) where rays hit the given element,
+        optionally only those coming from the given source."""
+        rays = self.rays[element + 1]
+        mask = rays.alive
+        if source is not None:
+            mask = mask & (rays.source == source)
+        return rays.endpoints[mask]
+
+    def paths(self, final_length=1):
+        """
+        The path of each ray as one array of vertices (M, 3) and an
+        array of offsets (N + 1,), where ray j consists of the vertices
+        offsets[j]:offsets[j + 1]. Each path ends with a point
+        final_length along the last direction, if there is one.
+        """
+        alive = np.array([rays.alive for rays in self.rays])
+        points = np.array([rays.endpoints for rays in self.rays])
+        last = self.rays[0].copy()
+        for rays in self.rays[1:]:
+            last.directions[rays.alive] = rays.directions[rays.alive]
+            last.endpoints[rays.alive] = rays.endpoints[rays.alive]
+        with np.errstate(invalid="ignore"):
+            final = last.along(final_length)
+            has_final = alive[0] & ~np.isnan(final[:, 0])
+        # ray-major order, so that each path is contiguous
+        alive = np.vstack([alive, has_final]).T
+        points = np.concatenate([points, final[np.newaxis]]).swapaxes(0, 1)
+        offsets = np.zeros(len(alive) + 1, dtype=int)
+        np.cumsum(alive.sum(axis=1), out=offsets[1:])
+        return points[alive], offsets
+
+
+class TraceFootprints(object):
+
+    """The footprints from a parallel trace, kept in shared memory.
+
+    There is one slot per traced ray, in source order, so the arrays
+    do not depend on how the work was split. wavelengths and source
+    are per ray; x, y and hit are lists with one array per element,
+    giving where (in the element's local coordinates) the ray hit it.
+
+    Elements with a histogram footprint get None instead of arrays;
+    their histograms are collected per chunk (see _trace_chunk), so
+    that the memory they use does not depend on the number of rays.
+    """
+
+    def __init__(self, n_rays, elements):
+        kept = [element.footprint_mode != "histogram"
+                for element in elements]
+        n = n_rays if any(kept) else 0
+        self.wavelengths = _shared(n, "d")
+        self.source = _shared(n, "i", np.int32)
+        self.x = [_shared(n, "d") if keep else None for keep in kept]
+        self.y = [_shared(n, "d") if keep else None for keep in kept]
+        self.hit = [_shared(n, "b", bool) if keep else None
+                    for keep in kept]
+
+    def store(self, start, result, elements):
+        """Copy a TraceResult of the given elements into the slots
+        from start onwards."""
+        first = result.rays[0]
+        end = start + len(first)
+        if not len(self.wavelengths):
+            return
+        self.wavelengths[start:end] = first.wavelengths
+        self.source[start:end] = first.source
+        for i, (element, rays) in enumerate(zip(elements, result.rays[1:])):
+            if self.x[i] is None:
+                continue
+            points = element.localize_vectors(rays.endpoints)
+            self.x[i][start:end] = points[:, 0]
+            self.y[i][start:end] = points[:, 1]
+            self.hit[i][start:end] = rays.alive
+
+    def element(self, i, source=None):
+        """The x, y and wavelength arrays of the hits on element i."""
+        mask = self.hit[i]
+        if source is not None:
+            mask = mask & (self.source == source)
+        return self.x[i][mask], self.y[i][mask], self.wavelengths[mask]
+
+    def _arrays(self):
+        """The shared arrays, by name."""
+        if not len(self.wavelengths):
+            return {}
+        arrays = dict(wavelengths=self.wavelengths, source=self.source)
+        for name in ("x", "y", "hit"):
+            for i, array in enumerate(getattr(self, name)):
+                if array is not None:
+                    arrays["%s%d" % (name, i)] = array
+        return arrays
+
+    def state(self, slots):
+        """The contents of the given (start, count) ranges of slots,
+        as a dict of arrays, e.g. for a checkpoint."""
+        return dict((name, np.concatenate([array[start:start + count]
+                                           for start, count in slots]))
+                    for name, array in self._arrays().items())
+
+    def restore(self, slots, state):
+        """Set the given ranges of slots from an earlier state(slots)."""
+        for name, array in self._arrays().items():
+            offset = 0
+            for start, count in slots:
+                array[start:start + count] = state[name][offset:
+                                                         offset + count]
+                offset += count
+
+
+def _shared(n, typecode, dtype=float):
+    """A numpy array of length n in memory shared with child processes."""
+    return np.frombuffer(RawArray(typecode, max(n, 1)), dtype=dtype)[:n]
+
+
+# State of a parallel trace worker process, inherited from the parent.
+_worker = {}
+
+
+def _init_worker(system, footprints):
+    _worker["system"] = system
+    _worker["footprints"] = footprints
+
+
+def _trace_chunk(task):
+    """Trace one chunk of rays from one source, in a worker process.
+    Besides the loss counts, returns the histograms of the chunk for
+    elements with a histogram footprint, unless tracing into a sink."""
+    system, footprints = _worker["system"], _worker["footprints"]
+    index, start, count, chunk = task
+    wanted = [False] * len(system.elements)
+    if isinstance(footprints, TraceFootprints):
+        wanted = [x is None for x in footprints.x]
+    result, histograms = system._trace_chunk(index, count, chunk, wanted)
+    footprints.store(start, result, system.elements)
+    return task, system.losses(), system.stats, histograms
+
+
+# Seconds between the checkpoints of a parallel trace
+CHECKPOINT_INTERVAL = 60.0
+
+
+def _histogram_arrays(elements):
+    """The counts of the histogram footprints, as a dict of arrays."""
+    arrays = {}
+    for i, element in enumerate(elements):
+        if element.footprint_mode == "histogram":
+            counts = element.footprint.as_arrays()
+            keys = sorted(counts)
+            arrays["keys%d" % i] = np.array(keys, dtype=float).reshape(-1, 2)
+            arrays["counts%d" % i] = np.array(
+                [counts[key] for key in keys],
+                dtype=np.int64).reshape((-1,) + element.footprint.bins)
+    return arrays
+
+
+def _savez(path, **arrays):
+    """np.savez, but replacing the file in one go, so that a crash
+    while writing leaves the previous one."""
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        np.savez(f, **arrays)
+    os.rename(temp, path)
+
+
+def _save_checkpoint(path, info, done, parts, tasks, elements, footprints):
+    """Write the progress of a parallel trace: the (source, chunk)
+    pairs done, and the loss counts and histograms of the elements so
+    far, to path. The state of the footprints of the given newly done
+    tasks goes in a new part file next to it, so each checkpoint only
+    writes what was traced since the last one. parts is the list of
+    earlier part files, and gets the new one added."""
+    slots = sorted((task[1], task[2]) for task in tasks)
+    state = footprints.state(slots) if slots else {}
+    if state:
+        part = "%s.%d" % (path, len(parts))
+        _savez(part, slots=np.array(slots, dtype=np.int64).reshape(-1, 2),
+               **state)
+        parts.append(os.path.basename(part))
+    info = dict(info, done=sorted(done), parts=parts,
+                losses=[dict(element.losses) for element in elements])
+    _savez(path, info=json.dumps(info), **_histogram_arrays(elements))
+
+
+def _load_checkpoint(path, info, elements, footprints):
+    """Restore the loss counts and histograms of the elements, and the
+    footprints, from a checkpoint of the same trace (described by
+    info). Returns the (source, chunk) pairs done and the list of part
+    files."""
+    data = np.load(path)
+    try:
+        saved = json.loads(str(data["info"]))
+        if any(saved.get(key) != value for key, value in info.items()):
+            raise ValueError("The checkpoint %s is for another trace" % path)
+        for part in saved["parts"]:
+            state = np.load(os.path.join(os.path.dirname(path), part))
+            try:
+                footprints.restore(state["slots"].tolist(), state)
+            finally:
+                state.close()
+        for i, element in enumerate(elements):
+            element.losses.merge(saved["losses"][i])
+            if "keys%d" % i in data.files:
+                for (source, wavelength), counts in zip(
+                        data["keys%d" % i], data["counts%d" % i]):
+                    element.footprint.add_counts(int(source), wavelength,
+                                                 counts)
+    finally:
+        data.close()
+    return set(tuple(pair) for pair in saved["done"]), saved["parts"]
 
 
 class OpticalSystem(object):
@@ -12,8 +245,14 @@ class OpticalSystem(object):
 
     A Source is a generator of Rays. An Element is something that a
     Ray can interact with, for example a mirror that can reflect it.
+
+    If collect_stats() has been called, stats is a TraceStats with the
+    timing and ray counts of the last trace. Otherwise it is None, and
+    nothing is measured.
     """
 
+    stats = None
+
     def __init__(self, elements=None, sources=None):
         if elements is not None:
             self.elements = elements
@@ -42,6 +281,8 @@ class OpticalSystem(object):
         direction.
         """
 
+        if self.stats is not None:
+            return self._propagate_timed(ray, system)
         trace = [ray]
         for el in self.elements:
             if ray.direction is None:
@@ -52,14 +293,251 @@ class OpticalSystem(object):
             trace.append(ray)
         return trace
 
-    def trace(self, n=1):
-        """Generate some rays and propagate them through the system."""
+    def _propagate_timed(self, ray, system):
+        """propagate, while adding to the stats."""
+        stats = self.stats
+        trace = [ray]
+        for i, el in enumerate(self.elements):
+            if ray.direction is None:
+                break
+            start = time()
+            ray = el.propagate(ray, system)
+            seconds = time() - start
+            stats.add_element(i, seconds, 1, ray is not None)
+            stats.add_source(system, seconds)
+            if ray is None:
+                break
+            trace.append(ray)
+        return trace
+
+    def propagate_many(self, rays, record=True):
+        """Batch version of propagate. The RayBundle is pushed through
+        each element in turn; rays that miss are masked out but kept
+        in the bundle. Returns a TraceResult.
+        """
+        if self.stats is not None:
+            return self._propagate_many_timed(rays, record)
+        bundles = [rays]
+        for el in self.elements:
+            rays = el.propagate_many(rays, record)
+            bundles.append(rays)
+        return TraceResult(bundles)
+
+    def _propagate_many_timed(self, rays, record):
+        """propagate_many, while adding to the stats."""
+        stats = self.stats
+        counts = np.bincount(rays.source[rays.alive],
+                             minlength=len(self.sources))
+        total = 0.0
+        bundles = [rays]
+        for i, el in enumerate(self.elements):
+            rays_in = np.count_nonzero(rays.alive &
+                                       ~np.isnan(rays.directions[:, 0]))
+            start = time()
+            rays = el.propagate_many(rays, record)
+            seconds = time() - start
+            stats.add_element(i, seconds, rays_in,
+                              np.count_nonzero(rays.alive))
+            total += seconds
+            bundles.append(rays)
+        stats.share_time(total, counts.tolist())
+        return TraceResult(bundles)
+
+    def generate_many(self, n=1):
+        """Generate n rays from each source, as one RayBundle."""
+        return RayBundle.concatenate([self._generate_many(i, n)
+                                      for i in xrange(len(self.sources))])
+
+    def _generate_many(self, index, n, chunk=0):
+        """Generate chunk number chunk of the rays from a source,
+        marked with the index of the source."""
+        start = time()
+        rays = self.sources[index].generate_many(n, chunk)
+        rays.source[:] = index
+        if self.stats is not None:
+            self.stats.add_source(index, time() - start, n)
+        return rays
+
+    def _trace_chunk(self, index, n, chunk, wanted=None):
+        """Trace chunk number chunk, of n rays, from the source with the
+        given index, as one piece of a trace split into chunks. The
+        records are cleared first, so that the loss counts are those of
+        the chunk. Returns the TraceResult, and for each element a new
+        footprint (see Element.new_footprint) of its hits, or None if
+        not wanted (a list of booleans, by default all True)."""
+        self.clear_records()
+        rays = self._generate_many(index, n, chunk)
+        result = self.propagate_many(rays, record=False)
+        footprints = []
+        for i, (element, bundle) in enumerate(zip(self.elements,
+                                                  result.rays[1:])):
+            footprint = None
+            if wanted is None or wanted[i]:
+                footprint = element.new_footprint()
+                footprint.extend_from_bundle(element.localize_many(bundle))
+            footprints.append(footprint)
+        return result, footprints
 
+    def trace_bundle(self, n=1):
+        """Generate n rays from each source and propagate them all
+        through the system at once. Returns a TraceResult."""
+        self.clear_records()
+        return self.propagate_many(self.generate_many(n))
+
+    def clear_records(self):
+        """Clear the footprints and loss counts of the elements, and
+        the stats."""
         for element in self.elements:
-            element.footprint = []
+            element.footprint.clear()
+            element.losses.clear()
+        if self.stats is not None:
+            self.stats = TraceStats(len(self.elements), len(self.sources))
+
+    def collect_stats(self, on=True):
+        """Turn on (or off) the timing and counting of rays in
+        traces. The results of the last trace are in stats."""
+        if not on:
+            self.stats = None
+        elif self.stats is None:
+            self.stats = TraceStats(len(self.elements), len(self.sources))
+
+    def record(self, result, losses=None):
+        """Replace the footprints of the elements with the ones from
+        a TraceResult, e.g. one traced earlier, and the loss counts
+        with the given ones (a list with one dict per element)."""
+        self.clear_records()
+        for element, rays in zip(self.elements, result.rays[1:]):
+            element.footprint.extend_from_bundle(element.localize_many(rays))
+        for element, counts in zip(self.elements, losses or []):
+            element.losses.merge(counts)
+
+    def losses(self):
+        """The loss counts of each element, from the last trace."""
+        return [dict(element.losses) for element in self.elements]
+
+    def trace_chunks(self, n=1, chunk_size=1000):
+        """Trace n rays from each source, chunk_size rays at a time.
+        This is a generator of a TraceResult for each chunk, so that
+        the first results are available without waiting for the rest.
+        The chunks are the same as in a parallel trace (see trace).
+        """
+        self.clear_records()
+        for i in xrange(len(self.sources)):
+            for chunk, start in enumerate(xrange(0, n, chunk_size)):
+                rays = self._generate_many(i, min(chunk_size, n - start),
+                                           chunk)
+                yield self.propagate_many(rays)
+
+    def trace(self, n=1, workers=None, chunk_size=10000, sink=None,
+              checkpoint=None, resume=False):
+        """Generate some rays and propagate them through the system.
+
+        By default this is a generator of (source index, trace) for
+        each ray, one ray at a time. Given a number of workers, the
+        rays are instead traced as bundles of chunk_size rays on that
+        many processes, and the footprints are merged into the
+        elements; the merged arrays are returned as TraceFootprints.
+        Each chunk is generated from its own random stream (see
+        Source.random_state), so the result is the same for any number
+        of workers.
+
+        Given a sink (see phoray.sink.TraceSink.create), the rays are
+        traced the same way (on one worker by default), but the hits
+        are written to the sink instead of the footprints, and the
+        sink is returned.
+
+        Given a checkpoint file name, the progress of a parallel trace
+        is saved there every CHECKPOINT_INTERVAL seconds, and when it
+        is done. Each checkpoint adds the footprints traced since the
+        last one in a part file next to it (checkpoint.0, .1, ...), so
+        that it does not write everything again. With resume, a trace
+        continues from the checkpoint left by an interrupted one with
+        the same n and chunk_size. Since the random numbers only depend
+        on the chunk, the result is the same as if it had not been
+        interrupted.
+        """
+        if sink is not None or checkpoint is not None:
+            return self._trace_parallel(n, workers or 1, chunk_size, sink,
+                                        checkpoint, resume)
+        if workers is None:
+            return self._trace(n)
+        return self._trace_parallel(n, workers, chunk_size)
+
+    def _trace_parallel(self, n, workers, chunk_size, sink=None,
+                        checkpoint=None, resume=False):
+        if sink is not None:
+            footprints = sink
+        else:
+            footprints = TraceFootprints(n * len(self.sources),
+                                         self.elements)
+        tasks = []
+        for i in xrange(len(self.sources)):
+            for chunk, start in enumerate(xrange(0, n, chunk_size)):
+                tasks.append((i, i * n + start, min(chunk_size, n - start),
+                              chunk))
+        self.clear_records()
+
+        # What a checkpoint must match to be resumed from
+        info = dict(rays=n, chunk_size=chunk_size,
+                    elements=len(self.elements),
+                    seeds=[source.random_seed for source in self.sources])
+        done, parts, new = set(), [], []
+        if resume and checkpoint and os.path.exists(checkpoint):
+            done, parts = _load_checkpoint(checkpoint, info, self.elements,
+                                           footprints)
+            tasks = [task for task in tasks if (task[0], task[3]) not in done]
+
+        pool = Pool(workers, _init_worker, (self, footprints))
+        saved = time()
+        try:
+            for task, losses, stats, histograms in pool.imap_unordered(
+                    _trace_chunk, tasks):
+                for element, counts, histogram in zip(self.elements, losses,
+                                                      histograms):
+                    element.losses.merge(counts)
+                    if histogram is not None:
+                        element.footprint.merge(histogram)
+                if stats is not None:
+                    self.stats.merge(stats)
+                done.add((task[0], task[3]))
+                new.append(task)
+                if checkpoint and time() - saved > CHECKPOINT_INTERVAL:
+                    # Chunks still being traced are not marked done, so
+                    # a resumed trace will redo them
+                    _save_checkpoint(checkpoint, info, done, parts, new,
+                                     self.elements, footprints)
+                    saved, new = time(), []
+        except BaseException:
+            # e.g. a failed chunk or Ctrl-C: do not wait for the rest
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        if checkpoint:
+            _save_checkpoint(checkpoint, info, done, parts, new,
+                             self.elements, footprints)
+
+        if sink is not None:
+            sink.finish(self.losses())
+            return sink
+        for i, element in enumerate(self.elements):
+            if footprints.x[i] is None:
+                continue  # the histogram is already merged
+            for source in xrange(len(self.sources)):
+                element.footprint.extend(source,
+                                         *footprints.element(i, source))
+        return footprints
+
+    def _trace(self, n):
+        self.clear_records()
 
         for i, source in enumerate(self.sources):
-            for ray in source.generate(n):
+            rays = source.generate(n)
+            if self.stats is not None:
+                rays = self.stats.generated(i, rays)
+            for ray in rays:
                 trace = self.propagate(ray, i)
                 yield i, trace
 
@@ -1,50 +1,24 @@
 from pprint import pprint
-from inspect import getmembers, isclass, getmro
-from imp import find_module, load_module
-from operator import itemgetter
+from base64 import b64encode
 import json
-import copy
 import os
 from collections import OrderedDict
 
-from bottle import get, post, request, run, static_file, route
-from phoray import system, element, surface, source
+from bottle import (get, post, request, response, run, static_file, route,
+                    abort)
+import numpy as np
+from phoray import system
+from phoray.spec import (system_classes, element_classes, surface_classes,
+                         source_classes, create_geometry, create_element,
+                         create_source, load_plugins)
+from phoray.sweep import sweep
 import util
+from jobs import JobQueue
 
 optical_systems = []
 
-# Figure out what plugins are available
-
 PLUGIN_DIR = "plugins"
-plugins = [os.path.splitext(mod)[0]
-           for mod in os.listdir(PLUGIN_DIR) if mod.endswith(".py")]
-plugin_classes = [
-    #(plugin + "." + name, cls)
-    (name, cls)
-    for plugin, module
-    in ((plug, load_module(plug, *find_module(plug, [PLUGIN_DIR])))
-        for plug in sorted(plugins))
-    for name, cls in sorted(getmembers(module, isclass), key=itemgetter(0))]
-
-# List all the things we have available, by checking which classes
-# inherit the different base classes.
-
-system_classes = OrderedDict((name, cls) for name, cls
-                             in sorted(getmembers(system, isclass),
-                                       key=itemgetter(0)) + plugin_classes
-                             if system.OpticalSystem in getmro(cls)[1:])
-element_classes = OrderedDict((name, cls) for name, cls
-                              in sorted(getmembers(element, isclass),
-                                        key=itemgetter(0)) + plugin_classes
-                              if element.Element in getmro(cls)[1:])
-surface_classes = OrderedDict((name, cls) for name, cls
-                              in sorted(getmembers(surface, isclass),
-                                        key=itemgetter(0)) + plugin_classes
-                              if surface.Surface in getmro(cls)[1:])
-source_classes = OrderedDict((name, cls) for name, cls
-                             in sorted(getmembers(source, isclass),
-                                       key=itemgetter(0)) + plugin_classes
-                             if source.Source in getmro(cls)[1:])
+load_plugins(PLUGIN_DIR)
 
 # Find out the argument types for each class.
 
@@ -58,33 +32,6 @@ schemas = dict(System=OrderedDict((name, {})
                                   for name, cls in source_classes.items()))
 
 
-def create_geometry(spec):
-    cls = surface_classes.get(spec["type"])
-    args = dict((name, prop) for name, prop in spec["args"].items())
-    geometry = cls(**args)
-    geometry.id = spec["id"]
-    return geometry
-
-
-def create_element(spec):
-    cls = element_classes[spec["type"]]
-    args = dict((name, prop) for name, prop in spec["args"].items())
-    args["geometry"] = create_geometry(args["geometry"])
-    element = cls(**args)
-    element.id = spec["id"]
-    return element
-
-
-def create_source(spec):
-    print "source spec"
-    pprint(spec)
-    cls = source_classes.get(spec["type"])
-    args = dict((name, prop) for name, prop in spec["args"].items())
-    source = cls(**args)
-    source.id = spec["id"]
-    return source
-
-
 @route('/')
 def staticindex():
     return static_file('index.html', root='ui')
@@ -104,46 +51,90 @@ def get_schema():
             "source": schemas["Source"]}
 
 
+# The elements and sources of the current systems, by id, along with
+# a fingerprint of the spec each was created from.
+built_members = {}
+
+
+def build_member(create, spec, previous):
+    """Return the object for the given spec, and whether it is new.
+    The one from the previous definition is reused if its spec is
+    unchanged."""
+    key = util.fingerprint(spec)
+    if spec["id"] in previous:
+        old_key, member = previous[spec["id"]]
+        if old_key == key:
+            built_members[spec["id"]] = old_key, member
+            return member, False
+    member = create(spec)
+    built_members[spec["id"]] = key, member
+    return member, True
+
+
+def changes_members(sys_class):
+    """Whether the system class overrides update(), which may move
+    its elements around."""
+    return sys_class.update.im_func is not system.OpticalSystem.update.im_func
+
+
 @post('/system')
 def define_system():
-    """Define some elements to make up the optical system."""
+    """Define some elements to make up the optical system.
 
-    global optical_systems
+    Elements and sources are kept between calls, and only the ones
+    whose spec has changed are created again.
+    """
+
+    global optical_systems, built_members
     optical_systems = []
+    previous, built_members = built_members, {}
 
     query = request.json
-    specs = copy.deepcopy(query)
 
-    pprint(specs)
+    # Which members to check against the spec afterwards
+    rebuilt = []
 
-    for spec in specs["systems"]:
+    for spec in query["systems"]:
         sys_class = system_classes[spec["type"]]
         system = sys_class()
         system.id = spec["id"]
+        check_all = changes_members(sys_class)
 
+        elements_rebuilt = []
         for ele_spec in spec["elements"]:
-            emt = create_element(ele_spec)
+            emt, new = build_member(create_element, ele_spec, previous)
             system.elements.append(emt)
+            elements_rebuilt.append(new or check_all)
 
+        sources_rebuilt = []
         for src_spec in spec["sources"]:
             try:
-                src = create_source(src_spec)
+                src, new = build_member(create_source, src_spec, previous)
                 system.sources.append(src)
+                sources_rebuilt.append(new or check_all)
             except KeyError as e:
                 print "Error:", str(e)
 
         system.update()
+        # Anything that can change the traced rays, but not e.g. colors
+        system.fingerprint = util.fingerprint(
+            [util.without_keys(spec, ("id", "color")),
+             [src.random_seed for src in system.sources]])
         optical_systems.append(system)
+        rebuilt.append((elements_rebuilt, sources_rebuilt))
 
     # Figure out if anything has changed from the recieved spec
     diff = []
     for i, sys in enumerate(optical_systems):
         qsys = query["systems"][i]
+        elements_rebuilt, sources_rebuilt = rebuilt[i]
         element_diffs = [util.dictdiff(qsys["elements"][j],
                                        util.object_to_dict(el, schemas))
+                         if elements_rebuilt[j] else {}
                          for j, el in enumerate(sys.elements)]
         source_diffs = [util.dictdiff(qsys["sources"][j],
                                       util.object_to_dict(so, schemas))
+                        if sources_rebuilt[j] else {}
                         for j, so in enumerate(sys.sources)]
         system_diff = {}
         if any(element_diffs):
@@ -174,8 +165,9 @@ def add_system():
 def add_element():
     query = request.json
     cls = element_classes[query["type"]]
-    where = optical_systems[query["system"]].elements
-    where.insert(query["index"], cls())
+    system = optical_systems[query["system"]]
+    system.fingerprint = None
+    system.elements.insert(query["index"], cls())
     return get_system()
 
 
@@ -183,19 +175,38 @@ def add_element():
 def add_source():
     query = request.json
     cls = source_classes[query["type"]]
-    where = optical_systems[query["system"]].sources
-    where.insert(query["index"], cls())
+    system = optical_systems[query["system"]]
+    system.fingerprint = None
+    system.sources.insert(query["index"], cls())
     return get_system()
 
 
+# Encoded meshes, by geometry and resolution. The size is in bytes.
+mesh_cache = util.LRUCache(50 * 1024 ** 2, sizeof=len)
+
+
 @get('/mesh')
 def get_mesh():
     """Return a mesh representation of an element."""
     query = request.query
     spec = json.loads(query["geometry"])
-    geo = create_geometry(spec)
-    verts, faces = geo.mesh(int(query.resolution))
-    return {"verts": verts, "faces": faces}
+    resolution = int(query.resolution)
+    key = util.fingerprint(dict(type=spec["type"], args=spec["args"],
+                                resolution=resolution))
+    mesh = mesh_cache.get(key)
+    if mesh is None:
+        geo = create_geometry(spec)
+        verts, faces = geo.mesh(resolution)
+        mesh = json.dumps({"verts": verts, "faces": faces})
+        mesh_cache.put(key, mesh)
+    response.content_type = "application/json"
+    return mesh
+
+
+@get('/mesh/cache')
+def get_mesh_cache():
+    """Return the hit/miss statistics of the mesh cache."""
+    return mesh_cache.stats()
 
 
 @get('/system')
@@ -221,27 +232,205 @@ def axis():
                      for pt in optical_systems[0].axis()]}
 
 
+def trace_paths(traced, n_sources):
+    """The paths of a TraceResult as lists of points, by source."""
+    result = dict((i, []) for i in xrange(n_sources))
+    vertices, offsets = traced.paths()
+    vertices = vertices.tolist()
+    offsets = offsets.tolist()
+    for j, source in enumerate(traced.rays[0].source.tolist()):
+        path = vertices[offsets[j]:offsets[j + 1]]
+        if path:
+            result[source].append(path)
+    return result
+
+
+def pack_paths(vertices, offsets, sources):
+    """
+    Pack ray paths into a little-endian binary blob:
+
+        uint32  n                    number of (non-empty) paths
+        uint32  offsets[n + 1]       first vertex of each path
+        uint32  sources[n]           source index of each path
+        float32 vertices[3 * offsets[n]]
+
+    This is a lot smaller and faster to produce (and to parse) than
+    the equivalent JSON lists.
+    """
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    offsets = np.concatenate(([0], np.cumsum(lengths[nonempty])))
+    n = np.count_nonzero(nonempty)
+    return "".join((np.array([n], dtype="<u4").tostring(),
+                    offsets.astype("<u4").tostring(),
+                    sources[nonempty].astype("<u4").tostring(),
+                    vertices.astype("<f4").tostring()))
+
+
+def trace_size(entry):
+    """Roughly the memory used by a cached trace, in bytes."""
+    traced, body, losses = entry
+    return len(body) + sum(rays.endpoints.nbytes + rays.directions.nbytes +
+                           rays.wavelengths.nbytes + rays.alive.nbytes +
+                           rays.source.nbytes for rays in traced.rays)
+
+
+# Traced rays and the encoded response, by system fingerprint, n and
+# format.
+trace_cache = util.LRUCache(200 * 1024 ** 2, sizeof=trace_size)
+
+
+@get('/trace/cache')
+def get_trace_cache():
+    """Return the hit/miss statistics of the trace cache."""
+    return trace_cache.stats()
+
+
 @get('/trace')
 def trace():
-    """Trace the paths of a number of rays through a system."""
+    """Trace the paths of a number of rays through a system. With
+    stats=1, the timing and ray counts of each element and source are
+    included (the X-Stats header for format=f32), and the trace is not
+    taken from the cache."""
     query = request.query
     system = optical_systems[int(query.system)]
 
     n = int(query.n)  # number of rays to trace
-    result = {}
-
-    for i, source in enumerate(system.sources):
-        traces = []
-        for ray in source.generate(n):
-            tmp = [tuple(r.endpoint) for r in system.propagate(ray, i)]
-            if r.direction is None:
-                pass
+    binary = query.format == "f32"
+    stats = bool(query.stats)
+    system.collect_stats(stats)
+
+    fingerprint = None if stats else getattr(system, "fingerprint", None)
+    key = (fingerprint, n, binary)
+    cached = trace_cache.get(key) if fingerprint else None
+    if cached:
+        traced, body, losses = cached
+        system.record(traced, losses)  # so that /footprint matches
+    else:
+        traced = system.trace_bundle(n)
+        losses = system.losses()
+        if binary:
+            vertices, offsets = traced.paths()
+            body = pack_paths(vertices, offsets, traced.rays[0].source)
+        else:
+            result = {"traces": trace_paths(traced, len(system.sources)),
+                      "losses": losses}
+            if stats:
+                result["stats"] = system.stats.to_dict()
+            body = json.dumps(result)
+        if fingerprint:
+            trace_cache.put(key, (traced, body, losses))
+
+    if binary:
+        response.content_type = "application/octet-stream"
+        response.set_header("X-Losses", json.dumps(losses))
+        if stats:
+            response.set_header("X-Stats", json.dumps(system.stats.to_dict()))
+    else:
+        response.content_type = "application/json"
+    return body
+
+
+@get('/trace/stream')
+def trace_stream():
+    """
+    Trace rays like /trace, but send the paths as server-sent events,
+    one for each chunk of rays as soon as it is done. With format=f32
+    the data of each event is the binary format, base64 encoded.
+    The end of the trace is marked by a "done" event, with the number
+    of rays lost on each element (and the stats, with stats=1).
+    """
+    query = request.query
+    system = optical_systems[int(query.system)]
+    n = int(query.n)
+    chunk_size = int(query.chunk or 1000)
+    binary = query.format == "f32"
+    stats = bool(query.stats)
+    system.collect_stats(stats)
+
+    response.content_type = "text/event-stream"
+    response.set_header("Cache-Control", "no-cache")
+
+    def events():
+        for traced in system.trace_chunks(n, chunk_size):
+            if binary:
+                vertices, offsets = traced.paths()
+                data = b64encode(pack_paths(vertices, offsets,
+                                            traced.rays[0].source))
             else:
-                tmp.append(tuple(r.endpoint + r.direction * 1))
-            traces.append(tmp)
-        result[i] = traces
+                data = json.dumps(
+                    {"traces": trace_paths(traced, len(system.sources))})
+            yield "data: %s\n\n" % data
+        done = {"losses": system.losses()}
+        if stats:
+            done["stats"] = system.stats.to_dict()
+        yield "event: done\ndata: %s\n\n" % json.dumps(done)
+
+    return events()
+
+
+@get('/sweep')
+def get_sweep():
+    """Trace a system at each of a comma separated list of wavelengths,
+    and return the statistics of the hits on an element (by default
+    the last one) at each wavelength."""
+    query = request.query
+    system = optical_systems[int(query.system)]
+    wavelengths = [float(w) for w in query.wavelengths.split(",")]
+    n = int(query.n or 1000)
+    element = int(query.element or -1)
+    try:
+        results = sweep(system, wavelengths, n, element)
+    except ValueError as e:
+        abort(400, str(e))
+    return {"sweep": results, "losses": system.losses()}
+
+
+# Long traces, run in the background
+job_queue = JobQueue()
+
+
+@post('/job')
+def submit_job():
+    """Start tracing a system in the background. Returns the job id,
+    which can be used to follow the progress and get the results."""
+    query = request.json
+    system = optical_systems[int(query["system"])]
+    job = job_queue.submit(system, int(query["n"]),
+                           int(query.get("chunk", 10000)))
+    return job.progress()
+
+
+def find_job():
+    job = job_queue.get(int(request.query.id))
+    if job is None:
+        abort(404, "No such job: %s" % request.query.id)
+    return job
+
+
+@get('/job')
+def job_progress():
+    """Return how far a job has come: the number of rays traced and
+    lost so far, and an estimate of the time left in seconds."""
+    return find_job().progress()
+
+
+@get('/job/result')
+def job_result():
+    """Return the footprints on each element from a finished job."""
+    job = find_job()
+    progress = job.progress()
+    if progress["status"] == "done":
+        progress["elements"] = job.result()
+    return progress
+
 
-    return {"traces": result}
+@get('/losses')
+def losses():
+    """Return the number of rays lost on each element in the last
+    trace, by cause."""
+    system = optical_systems[int(request.query.system)]
+    return {"losses": system.losses()}
 
 
 @get('/footprint')
@@ -251,7 +440,10 @@ def footprint():
     sys_n = int(query.system)
     ele_n = int(query.element)  # the chosen element
 
-    return {"footprint": optical_systems[sys_n].elements[ele_n].footprint}
+    element = optical_systems[sys_n].elements[ele_n]
+    if element.footprint_mode == "histogram":
+        return {"histogram": element.footprint.to_dict()}
+    return {"footprint": element.footprint.to_dict()}
 
 
 # Start the server
@@ -246,12 +246,59 @@
         };
 
         self.trace = function () {
-            $.get("/trace", {n: 100, system: self.systems.indexOf(self.selected_system())},
-                  function (data) {
-                      view.clear_traces();
-                      view.draw_traces(data.traces, self.selected_system().sources().map(
-                          function(src) {return src.args.color()}));
-                  });
+            // The traces arrive in chunks, which are drawn as they come.
+            if (self.trace_stream) {
+                self.trace_stream.close();
+            }
+            var stream = new EventSource("/trace/stream?format=f32&n=100&chunk=25&system=" +
+                                         self.systems.indexOf(self.selected_system())),
+                colors = self.selected_system().sources().map(
+                    function(src) {return src.args.color()}),
+                first = true;
+            stream.onmessage = function (event) {
+                if (first) {
+                    view.clear_traces();
+                    first = false;
+                }
+                view.draw_traces_buffer(base64_buffer(event.data), colors);
+            };
+            stream.addEventListener("done", function () {
+                stream.close();
+            });
+            self.trace_stream = stream;
+        };
+
+        var base64_buffer = function (data) {
+            var bytes = atob(data), buffer = new Uint8Array(bytes.length);
+            for (var i = 0; i < bytes.length; i++) {
+                buffer[i] = bytes.charCodeAt(i);
+            }
+            return buffer.buffer;
+        };
+
+        // Turn a footprint histogram into a list of points, one for
+        // each non-empty bin.
+        var histogram_points = function (histogram) {
+            var nx = histogram.bins[0], ny = histogram.bins[1],
+                x0 = histogram.range[0][0], x1 = histogram.range[0][1],
+                y0 = histogram.range[1][0], y1 = histogram.range[1][1],
+                points = {};
+            for (var source in histogram.histograms) {
+                points[source] = [];
+                histogram.histograms[source].forEach(function (hist) {
+                    for (var i = 0; i < nx; i++) {
+                        for (var j = 0; j < ny; j++) {
+                            if (hist.counts[i][j] > 0) {
+                                points[source].push(
+                                    [x0 + (i + 0.5) * (x1 - x0) / nx,
+                                     y0 + (j + 0.5) * (y1 - y0) / ny,
+                                     hist.wavelength]);
+                            }
+                        }
+                    }
+                });
+            }
+            return points;
         };
 
         $( "#footprint" ).dialog({ autoOpen: false, width: 300, height: 300 });
@@ -266,6 +313,9 @@
                       $("#footprint").dialog("open");
                       //plot( data.footprint, "#footprint");
                       var datasets = [];
+                      if (data.histogram) {
+                          data.footprint = histogram_points(data.histogram);
+                      }
                       for (var source in data.footprint) {
                           var color = self.systems()[sys_index].sources()[source]
                                   .args.color();
@@ -169,6 +169,41 @@ var view3d = (function () {
         this.render();
     };
 
+    // Draw traces from the packed binary format of /trace?format=f32.
+    // All the paths from one source go into a single geometry, drawn
+    // as separate line segments, so there is one object per source
+    // instead of one per ray.
+    this.View.prototype.draw_traces_buffer = function (buffer, colors) {
+        var n = new Uint32Array(buffer, 0, 1)[0],
+            offsets = new Uint32Array(buffer, 4, n + 1),
+            sources = new Uint32Array(buffer, 4 * (n + 2), n),
+            vertices = new Float32Array(buffer, 4 * (2 * n + 2)),
+            geometries = {};
+        var vertex = function (i) {
+            return new THREE.Vector3(vertices[3 * i], vertices[3 * i + 1],
+                                     vertices[3 * i + 2]);
+        };
+        for (var i = 0; i < n; i++) {
+            var source = sources[i];
+            if (!geometries[source]) {
+                geometries[source] = new THREE.Geometry();
+            }
+            var points = geometries[source].vertices;
+            for (var j = offsets[i]; j < offsets[i + 1] - 1; j++) {
+                points.push(vertex(j), vertex(j + 1));
+            }
+        }
+        for (var source in geometries) {
+            var line = new THREE.Line(
+                geometries[source], new THREE.LineBasicMaterial( {
+                    color: color_from_string(colors[source]),
+                    opacity: 0.5, linewidth: 0.5} ), THREE.LinePieces);
+            this.traces.add(line);
+        }
+        this.scene.add(this.traces);
+        this.render();
+    };
+
     this.View.prototype.render = function (mouse_coords) {
 	this.theta = this.start_theta - 2 * (this.mouse_pos.x - this.mouse_start.x);
 	this.phi = Math.min(Math.PI/2,
@@ -1,5 +1,7 @@
 from collections import OrderedDict
+from hashlib import sha1
 import inspect
+import json
 
 from phoray import surface, element, source
 from phoray.minivec import Vec
@@ -110,3 +112,70 @@ def signature(cls):
                 argtype = "string"
             signature[arg] = dict(type=str(argtype), value=value)
     return signature
+
+
+def without_keys(obj, keys):
+    """A copy of a JSON-like object, with the given dict keys removed
+    at any depth."""
+    if isinstance(obj, dict):
+        return dict((k, without_keys(v, keys))
+                    for k, v in obj.items() if k not in keys)
+    if isinstance(obj, list):
+        return [without_keys(v, keys) for v in obj]
+    return obj
+
+
+def fingerprint(obj):
+    """A hash of a JSON-like object that does not depend on the order
+    of dict keys, so equal specs always give the same key."""
+    return sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+class LRUCache(object):
+
+    """A cache that drops the least recently used entries once the
+    total size of its values goes over max_size. The size of a value
+    is given by the sizeof function; by default each counts as 1.
+    """
+
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self.hits += 1
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)  # now the most recent
+            return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return  # would push out everything else
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return dict(entries=len(self), size=self.size,
+                    max_size=self.max_size, hits=self.hits,
+                    misses=self.misses)